@@ -0,0 +1,101 @@
+"""
+
+    migro.db.async_db_manager
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Database access from the event loop.
+
+"""
+
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import AsyncIterator, Callable, Iterable
+
+import click
+
+from db.db_manager import DBManager
+
+
+class AsyncDBManager:
+    """
+    Runs `DBManager` calls in a dedicated thread, one at a time in the order they are made,
+    so slow commits and checkpoints never block the event loop.
+    Once the facade is created, use the manager through it only, till `join` returns.
+    """
+    def __init__(self, db_manager: DBManager):
+        self.db_manager = db_manager
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='migro-db')
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """
+        Schedule a call without waiting for it, errors are reported.
+        """
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self._report)
+        return future
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """
+        Make a call and wait for its result.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        Make a call from another thread and wait for its result.
+        """
+        return self.executor.submit(func, *args, **kwargs).result()
+
+    async def iterate(self, iterable: Iterable, chunk_size: int = 1000) -> AsyncIterator:
+        """
+        Iterate over an iterable querying the database, `chunk_size` items are read at a time.
+        """
+        iterator = iter(iterable)
+        while True:
+            chunk = await self.run(lambda: list(islice(iterator, chunk_size)))
+            if not chunk:
+                return
+            for item in chunk:
+                yield item
+
+    async def flush_periodically(self) -> None:
+        """
+        Write the buffered updates left for `flush_interval` every `flush_interval` seconds
+        till cancelled, so they are saved and reported while the uploads stall.
+        """
+        while True:
+            await asyncio.sleep(self.db_manager.flush_interval)
+            await self.run(self.db_manager.flush_stale)
+
+    def set_file_uploaded(self, *args, **kwargs) -> Future:
+        """
+        Schedule `DBManager.set_file_uploaded` call.
+        """
+        return self.submit(self.db_manager.set_file_uploaded, *args, **kwargs)
+
+    def set_file_error(self, *args, **kwargs) -> Future:
+        """
+        Schedule `DBManager.set_file_error` call.
+        """
+        return self.submit(self.db_manager.set_file_error, *args, **kwargs)
+
+    def join(self) -> None:
+        """
+        Wait for all the calls made so far.
+        """
+        self.executor.submit(lambda: None).result()
+
+    def close(self) -> None:
+        """
+        Wait for all the calls made so far and stop the thread.
+        """
+        self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def _report(future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            click.secho("Failed to update the database:", fg='red')
+            click.secho(f"Error: {future.exception()}", fg='red')
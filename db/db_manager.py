@@ -8,12 +8,16 @@
 """
 
 import sqlite3
+import time
+from itertools import groupby, islice
 from pathlib import Path
 from sqlite3 import Connection, Error
-from typing import Optional, Tuple
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
 import click
 
+from db.journal import Journal
+
 
 def get_db_file() -> Path:
     """
@@ -22,17 +26,59 @@ def get_db_file() -> Path:
     return Path(__file__).resolve().parent / "migration.db"
 
 
+# File status updates, buffered by `DBManager`. They set absolute values only,
+# so the updates replayed from a journal after they were committed change nothing.
+SET_FILE_UPLOADED = """
+UPDATE files
+SET status = 'uploaded',
+error = NULL,
+uploadcare_uuid = ?,
+last_attempt_id = ?,
+retries = ?
+WHERE id = ?
+"""
+SET_FILE_ERROR = "UPDATE files SET status = 'error', error = ?, retries = ? WHERE id = ?"
+UPDATES = {
+    'uploaded': SET_FILE_UPLOADED,
+    'error': SET_FILE_ERROR,
+}
+
+
 class DBManager:
-    def __init__(self):
+    def __init__(self, db_file: Optional[Path] = None, verbose: bool = True,
+                 buffer_size: int = 1000, flush_interval: float = 1.0,
+                 journal: bool = True, worker: Optional[int] = None, compact_size: int = 100000):
         """
         Initialize the DBManager with the database file.
-        """
-        self.db_file: Path = get_db_file()
+
+        File status updates are buffered and written in one transaction when
+        `buffer_size` of them are collected or `flush_interval` seconds passed,
+        before any query that depends on them and on closing the connection.
+
+        Till then they are kept in the `journal`, replayed into the database on
+        the next start if the process gets killed. Every worker process has its
+        own journal, the main process replays them all. The journal is compacted
+        when it has `compact_size` records. Only one manager of a process may
+        keep the journal.
+        """
+        self.db_file: Path = db_file or get_db_file()
+        self.verbose = verbose
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.worker = worker
+        self.compact_size = compact_size
+        self._buffer: list[Tuple[str, tuple]] = []
+        self._flushed_at = time.monotonic()
+        # Called with report rows of the files updated by every flush.
+        self.on_flush: Optional[Callable[[List[tuple]], None]] = None
         self.conn: Connection = self.create_connection()
         if self.conn is None:
             raise Error("Failed to connect to the database.")
-        self.create_tables()
-          
+        self.migrate()
+        self.journal: Optional[Journal] = None
+        if journal:
+            self.replay_journals()
+            self.journal = Journal(self.get_journal_file())
 
     def create_connection(self) -> Connection:
         """
@@ -40,9 +86,15 @@ class DBManager:
         """
         conn = None
         try:
-            conn = sqlite3.connect(self.db_file, check_same_thread=False)
-            click.secho(f"Connected to the database: {self.db_file}", fg='green')
-            click.secho(f"SQLite version: {sqlite3.version}", fg='green')
+            # Worker processes share the database, wait for each other's locks.
+            conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=30)
+            # Readers don't block the writer and commits aren't synced till checkpoints,
+            # which is still safe against application crashes.
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            if self.verbose:
+                click.secho(f"Connected to the database: {self.db_file}", fg='green')
+                click.secho(f"SQLite version: {sqlite3.version}", fg='green')
         except Error as e:
             click.secho(f"Failed to connect to the database: {self.db_file}", fg='red')
             click.secho(f"Error: {e}", fg='red')
@@ -60,11 +112,39 @@ class DBManager:
             click.secho("Failed to execute SQL script:", fg='red')
             click.secho(f"Error: {e}", fg='red')
 
+    # Schema migrations, every database is upgraded from its `user_version`
+    # by the ones it misses. Append new migrations, never change the old ones.
+    MIGRATIONS = (
+        'create_tables',
+        'add_retries_column',
+        'add_claim_column',
+        'add_path_source_index',
+        'add_query_indexes',
+        'add_etag_columns',
+        'create_listings_table',
+    )
+
+    def migrate(self) -> None:
+        """
+        Apply the schema migrations the database misses.
+        """
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(self.MIGRATIONS[version:], version + 1):
+            try:
+                getattr(self, migration)()
+                self.conn.execute(f"PRAGMA user_version = {number}")
+                self.conn.commit()
+            except Error as e:
+                self.conn.rollback()
+                click.secho(f"Failed to migrate the database: {migration}", fg='red')
+                click.secho(f"Error: {e}", fg='red')
+                raise
+
     def create_tables(self) -> None:
         """
         Create `attempts` and `files` tables if they don't exist already.
         """
-        self.execute_sql("""
+        self.conn.executescript("""
         CREATE TABLE IF NOT EXISTS attempts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             source TEXT NOT NULL,
@@ -75,8 +155,6 @@ class DBManager:
             finished_at DATETIME NULL,
             error BOOLEAN DEFAULT 0
         );
-        """)
-        self.execute_sql("""
         CREATE TABLE IF NOT EXISTS files (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             path TEXT NOT NULL,
@@ -91,10 +169,71 @@ class DBManager:
         );
         """)
 
+    def add_retries_column(self) -> None:
+        """
+        Add the number of retries made for a file.
+        """
+        self.add_column('files', 'retries', 'INTEGER NOT NULL DEFAULT 0')
+
+    def add_claim_column(self) -> None:
+        """
+        Add the batch claim of a worker process.
+        """
+        self.add_column('files', 'claim', 'TEXT')
+
+    def add_path_source_index(self) -> None:
+        """
+        Make paths unique per source, removing duplicates.
+        """
+        self.conn.execute("DELETE FROM files WHERE id NOT IN (SELECT MIN(id) FROM files GROUP BY path, source)")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_files_path_source ON files (path, source)")
+
+    def add_query_indexes(self) -> None:
+        """
+        Add indexes for pending files, files of an attempt and files of a claim.
+        """
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_files_source_status ON files (source, status)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_files_attempt_status ON files (last_attempt_id, status)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_files_claim ON files (claim) WHERE claim IS NOT NULL")
+
+    def add_etag_columns(self) -> None:
+        """
+        Add the S3 ETag of a file and the file with the same content it duplicates.
+        """
+        self.add_column('files', 'etag', 'TEXT')
+        self.add_column('files', 'duplicate_of', 'INTEGER REFERENCES files(id)')
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_files_etag ON files (source, etag, file_size) WHERE etag IS NOT NULL")
+
+    def create_listings_table(self) -> None:
+        """
+        Create `listings` table of bucket prefixes with the last key listed.
+        """
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS listings (
+            bucket TEXT NOT NULL,
+            prefix TEXT NOT NULL,
+            level INTEGER NOT NULL,
+            last_key TEXT,
+            done BOOLEAN NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, prefix)
+        )
+        """)
+
+    def add_column(self, table: str, column: str, definition: str) -> None:
+        """
+        Add a column to a table created by a previous version if it's missing.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in (row[1] for row in cursor.fetchall()):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
     def file_exists(self, source: str, path: str) -> bool:
         """
         Check if a file key already exists in the database.
         """
+        self.flush()
         cursor = self.conn.cursor()
         cursor.execute("SELECT * FROM files WHERE path = ? AND source = ?", (path, source))
         return cursor.fetchone() is not None
@@ -104,11 +243,103 @@ class DBManager:
         Insert a new file record into the database if it
         doesn't already exist, including the file size.
         """
-        if not self.file_exists(source, path):
-            cursor = self.conn.cursor()
-            cursor.execute("INSERT INTO files (path, source, file_size, status) VALUES (?, ?, ?, 'pending')",
-                           (path, source, file_size))
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT OR IGNORE INTO files (path, source, file_size, status) VALUES (?, ?, ?, 'pending')",
+                       (path, source, file_size))
+        self.conn.commit()
+
+    def insert_files(self, files: Iterable[Tuple[str, Optional[int], Optional[str]]], source: str,
+                     attempt_id: Optional[int] = None, chunk_size: int = 10000) -> int:
+        """
+        Insert new file records from an iterable of paths, sizes and ETags in one transaction,
+        `chunk_size` records at a time, so the iterable is never read into memory at once.
+        Files already in the database are skipped, new ones are added to attempt `attempt_id`.
+        Return the number of inserted files.
+        """
+        cursor = self.conn.cursor()
+        files = iter(files)
+        changes = self.conn.total_changes
+        try:
+            while True:
+                chunk = [(path, source, file_size, etag, attempt_id)
+                         for path, file_size, etag in islice(files, chunk_size)]
+                if not chunk:
+                    break
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO files (path, source, file_size, etag, last_attempt_id, status) "
+                    "VALUES (?, ?, ?, ?, ?, 'pending')",
+                    chunk)
+        finally:
+            # Keep the files inserted before a failure, e.g. of the bucket listing.
             self.conn.commit()
+        return self.conn.total_changes - changes
+
+    def mark_duplicates(self, source: str, after_id: int = 0) -> int:
+        """
+        Mark files to upload with the same ETag and size as a file with a lower ID as its duplicates.
+        Duplicates aren't uploaded, they get the status and the uploadcare UUID of the original
+        when the attempt is finished. Only files with IDs greater than `after_id` are checked.
+        Return the number of duplicates among them.
+        """
+        self.flush()
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            UPDATE files
+            SET duplicate_of = (
+                SELECT MIN(original.id) FROM files AS original
+                WHERE original.source = files.source
+                AND original.etag = files.etag
+                AND original.file_size IS files.file_size
+            )
+            WHERE id > ?
+            AND source = ?
+            AND etag IS NOT NULL
+            AND duplicate_of IS NULL
+            AND status IN ('pending', 'error')
+            """,
+            (after_id, source))
+        cursor.execute("UPDATE files SET duplicate_of = NULL WHERE id > ? AND duplicate_of = id", (after_id,))
+        self.conn.commit()
+        cursor.execute(
+            "SELECT COUNT(*) FROM files WHERE id > ? AND source = ? AND duplicate_of IS NOT NULL "
+            "AND status IN ('pending', 'error')",
+            (after_id, source))
+        return cursor.fetchone()[0]
+
+    def _resolve_duplicates(self, attempt_id: int, after_id: int = 0) -> int:
+        """
+        Make duplicates of files neither uploaded nor in attempt `attempt_id`, e.g. left out
+        by its filter, duplicates of the file of the attempt with the lowest ID instead,
+        so the content is uploaded. Only files with IDs greater than `after_id` are checked.
+        Return the number of duplicates among them.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            UPDATE files
+            SET duplicate_of = (
+                SELECT MIN(original.id) FROM files AS original
+                WHERE original.source = files.source
+                AND original.etag = files.etag
+                AND original.file_size IS files.file_size
+                AND original.last_attempt_id = files.last_attempt_id
+            )
+            WHERE last_attempt_id = ?
+            AND id > ?
+            AND duplicate_of IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM files AS original
+                WHERE original.id = files.duplicate_of
+                AND (original.last_attempt_id = files.last_attempt_id OR original.status = 'uploaded')
+            )
+            """,
+            (attempt_id, after_id))
+        cursor.execute("UPDATE files SET duplicate_of = NULL WHERE last_attempt_id = ? AND id > ? "
+                       "AND duplicate_of = id", (attempt_id, after_id))
+        cursor.execute("SELECT COUNT(*) FROM files WHERE last_attempt_id = ? AND id > ? "
+                       "AND duplicate_of IS NOT NULL", (attempt_id, after_id))
+        return cursor.fetchone()[0]
 
     def start_attempt(self, source: str, files_count: int) -> int:
         """
@@ -122,50 +353,176 @@ class DBManager:
         self.conn.commit()
         return cursor.lastrowid
 
-    def finish_attempt(self, attempt_id: int) -> tuple:
+    def start_listing(self, bucket: str, prefixes: Iterable[str]) -> List[Tuple[str, int, Optional[str]]]:
         """
-        Retrieve attempt details including file list, and count of 'uploaded' and 'error' statuses.
+        Start a new listing of the bucket from `prefixes`, forgetting the previous one.
+        Return the prefixes to list with their levels and the keys to start after.
+        """
+        self.conn.execute("DELETE FROM listings WHERE bucket = ?", (bucket,))
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO listings (bucket, prefix, level) VALUES (?, ?, 0)",
+            [(bucket, prefix) for prefix in prefixes])
+        self.conn.commit()
+        return self.get_listing(bucket)
+
+    def get_listing(self, bucket: str) -> List[Tuple[str, int, Optional[str]]]:
+        """
+        Get the prefixes of the bucket not listed till the end yet,
+        with their levels and the last keys listed.
         """
+        cursor = self.conn.execute(
+            "SELECT prefix, level, last_key FROM listings WHERE bucket = ? AND NOT done ORDER BY prefix",
+            (bucket,))
+        return cursor.fetchall()
+
+    def insert_listed_files(self, source: str, bucket: str, prefix: str,
+                            files: List[Tuple[str, Optional[int], Optional[str]]],
+                            prefixes: List[Tuple[str, int]], last_key: Optional[str],
+                            attempt_id: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Insert files of a listing page of `prefix` and the prefixes found on it,
+        then save `last_key` of the page, so an interrupted listing resumes after it.
+        New files are added to attempt `attempt_id` and checked for duplicates.
+        Return the numbers of new files to upload and of their duplicates.
+        """
+        last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM files").fetchone()[0]
+        inserted = self.insert_files(files, source, attempt_id)
+        duplicates = self.mark_duplicates(source, last_id) if inserted else 0
+        if attempt_id is not None and duplicates:
+            duplicates = self._resolve_duplicates(attempt_id, last_id)
         cursor = self.conn.cursor()
-        cursor.execute("SELECT path, file_size, uploadcare_uuid, status, error FROM files WHERE last_attempt_id = ?",
-                       (attempt_id,))
-        file_list = cursor.fetchall()
+        cursor.executemany(
+            "INSERT OR IGNORE INTO listings (bucket, prefix, level) VALUES (?, ?, ?)",
+            [(bucket, found, level) for found, level in prefixes])
+        if last_key is not None:
+            cursor.execute(
+                "UPDATE listings SET last_key = ? WHERE bucket = ? AND prefix = ?",
+                (last_key, bucket, prefix))
+        if attempt_id is not None and inserted:
+            cursor.execute(
+                "UPDATE attempts SET files_count = files_count + ? WHERE id = ?",
+                (inserted - duplicates, attempt_id))
+        self.conn.commit()
+        return inserted - duplicates, duplicates
 
-        cursor.execute("SELECT COUNT(*) FROM files WHERE last_attempt_id = ? AND status = 'uploaded'", (attempt_id,))
-        count_uploaded = cursor.fetchone()[0]
+    def finish_listing(self, bucket: str, prefix: str) -> None:
+        """
+        Mark `prefix` of the bucket as listed till the end.
+        """
+        self.conn.execute("UPDATE listings SET done = 1 WHERE bucket = ? AND prefix = ?", (bucket, prefix))
+        self.conn.commit()
 
-        cursor.execute("SELECT COUNT(*) FROM files WHERE last_attempt_id = ? AND status = 'error'", (attempt_id,))
-        count_error = cursor.fetchone()[0]
+    def finish_attempt(self, attempt_id: int) -> tuple:
+        """
+        Retrieve attempt details including file list, and count of 'uploaded' and 'error' statuses.
+        The file list is a cursor, read it before making other queries.
+        Duplicates get the results of their originals, `on_flush` gets their rows.
+        """
+        self.flush()
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            UPDATE files
+            SET (status, uploadcare_uuid, error) = (
+                SELECT status, uploadcare_uuid, error FROM files AS original
+                WHERE original.id = files.duplicate_of
+            )
+            WHERE last_attempt_id = ?
+            AND duplicate_of IS NOT NULL
+            """,
+            (attempt_id,))
+        if self.on_flush and cursor.rowcount:
+            # Duplicates are updated here, not through the buffer.
+            self.on_flush(self.conn.execute(
+                "SELECT path, file_size, uploadcare_uuid, status, error FROM files "
+                "WHERE last_attempt_id = ? AND duplicate_of IS NOT NULL ORDER BY id",
+                (attempt_id,)))
+        cursor.execute(
+            """
+            SELECT
+                COALESCE(SUM(status = 'uploaded'), 0),
+                COALESCE(SUM(status = 'error'), 0)
+            FROM files
+            WHERE last_attempt_id = ?
+            """,
+            (attempt_id,))
+        count_uploaded, count_error = cursor.fetchone()
 
         cursor.execute(
             "UPDATE attempts SET finished_at = CURRENT_TIMESTAMP, successful_uploads = ?, failed_uploads = ? "
             "WHERE id = ?",
             (count_uploaded, count_error, attempt_id))
+        self.conn.commit()
+
+        file_list = self.conn.execute(
+            "SELECT path, file_size, uploadcare_uuid, status, error FROM files WHERE last_attempt_id = ?",
+            (attempt_id,))
 
         return file_list, attempt_id, count_uploaded, count_error
 
-    def set_attempt_for_files(self, attempt_id: int, ignore_errors: bool = False) -> None:
-        """
-        Set the last attempt ID for all files.
-        """
-        attempt: Tuple = self.get_attempt_by_id(attempt_id)
-        if attempt is not None:
-            cursor = self.conn.cursor()
-            if ignore_errors:
-                cursor.execute("SELECT id FROM files WHERE status = 'pending' AND source = ?",
-                               (attempt[1],))
-            else:
-                cursor.execute("SELECT id FROM files WHERE status IN ('pending', 'error') AND source = ?",
-                               (attempt[1],))
-            files = cursor.fetchall()
-            for file in files:
-                cursor.execute("UPDATE files SET last_attempt_id = ? WHERE id = ?", (attempt_id, file[0]))
-            self.conn.commit()
+    def _filter_files(self, prefix: str = '', min_size: Optional[int] = None, max_size: Optional[int] = None,
+                      file_filter: Optional[Callable[[str], bool]] = None) -> Tuple[str, tuple]:
+        """
+        Get the conditions of files with paths starting with `prefix`, sizes in the range,
+        if known, and paths passing `file_filter`, with their parameters.
+        """
+        conditions, params = [], []
+        if prefix:
+            # Paths starting with the prefix sort between it and its last character incremented.
+            conditions.append("AND path >= ? AND path < ?")
+            params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        if min_size is not None:
+            conditions.append("AND (file_size IS NULL OR file_size >= ?)")
+            params.append(min_size)
+        if max_size is not None:
+            conditions.append("AND (file_size IS NULL OR file_size <= ?)")
+            params.append(max_size)
+        if file_filter is not None:
+            self.conn.create_function('file_filter', 1, lambda path: bool(file_filter(path)))
+            conditions.append("AND file_filter(path)")
+        return ' '.join(conditions), tuple(params)
+
+    def set_attempt_for_files(self, attempt_id: int, ignore_errors: bool = False, prefix: str = '',
+                              min_size: Optional[int] = None, max_size: Optional[int] = None,
+                              file_filter: Optional[Callable[[str], bool]] = None) -> int:
+        """
+        Set the last attempt ID for all files of the attempt source to upload,
+        with paths starting with `prefix`, sizes in the range, if known,
+        and paths passing `file_filter`, if given.
+        Duplicates of files neither uploaded nor in the attempt get the file of
+        the attempt with the lowest ID as the original, which is uploaded instead.
+        Save and return the number of files to upload, except duplicates.
+        """
+        self.flush()
+        statuses = ('pending',) if ignore_errors else ('pending', 'error')
+        conditions, params = self._filter_files(prefix, min_size, max_size, file_filter)
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f"""
+            UPDATE files
+            SET last_attempt_id = ?, claim = NULL
+            WHERE status IN ({', '.join('?' * len(statuses))})
+            AND source = (SELECT source FROM attempts WHERE id = ?)
+            {conditions}
+            """,
+            (attempt_id, *statuses, attempt_id, *params))
+        self._resolve_duplicates(attempt_id)
+        cursor.execute(
+            """
+            UPDATE attempts SET files_count = (
+                SELECT COUNT(*) FROM files WHERE last_attempt_id = attempts.id AND duplicate_of IS NULL
+            )
+            WHERE id = ?
+            """,
+            (attempt_id,))
+        self.conn.commit()
+        return self.conn.execute("SELECT files_count FROM attempts WHERE id = ?", (attempt_id,)).fetchone()[0]
 
     def get_not_uploaded_files_size(self) -> int:
         """
         Get the total size of files that are not uploaded yet.
         """
+        self.flush()
         cursor = self.conn.cursor()
         cursor.execute("SELECT SUM(file_size) FROM files WHERE status != 'uploaded'")
         return cursor.fetchone()[0]
@@ -174,6 +531,7 @@ class DBManager:
         """
         Get the total size and the number of files that are not uploaded yet.
         """
+        self.flush()
         cursor = self.conn.cursor()
         cursor.execute("SELECT COUNT(*), SUM(file_size) FROM files WHERE status != 'uploaded'")
         result = cursor.fetchone()
@@ -183,46 +541,210 @@ class DBManager:
 
     def get_pending_files(self, source, include_errors: bool = True) -> list[str]:
         """
-        Get the list of pending files.
+        Get the list of pending files, except duplicates.
         """
+        self.flush()
         cursor = self.conn.cursor()
-        query = "SELECT path FROM files WHERE status = 'pending' AND source = ?"
+        query = "SELECT path FROM files WHERE status = 'pending' AND source = ? AND duplicate_of IS NULL"
         if include_errors:
-            query = "SELECT path FROM files WHERE status IN ('pending', 'error') AND source = ?"
+            query = ("SELECT path FROM files WHERE status IN ('pending', 'error') AND source = ? "
+                     "AND duplicate_of IS NULL")
 
         cursor.execute(query, (source,))
         return [row[0] for row in cursor.fetchall()]
 
-    def set_file_uploaded(self, path: str, source: str, attempt: int, uploadcare_uuid: str) -> None:
+    def iter_pending_files(self, source, include_errors: bool = True,
+                           chunk_size: int = 1000) -> Iterator[Tuple[int, str, Optional[int]]]:
+        """
+        Iterate over IDs, paths and sizes of pending files, except duplicates, in the order of IDs.
+        Files are read `chunk_size` at a time, each chunk starts after the last ID
+        of the previous one, so the files updated in between are neither skipped nor repeated.
+        """
+        last_id = 0
+        while True:
+            rows = self.get_pending_files_page(source, last_id, chunk_size, include_errors)
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1][0]
+
+    def get_pending_files_page(self, source, after_id: int, limit: int, include_errors: bool = True,
+                               attempt_id: Optional[int] = None) -> List[Tuple[int, str, Optional[int]]]:
+        """
+        Get IDs, paths and sizes of up to `limit` pending files, except duplicates,
+        with IDs greater than `after_id`, in the order of IDs.
+        Only the files of `attempt_id` are returned if it's given.
+        """
+        statuses = ('pending', 'error') if include_errors else ('pending',)
+        params = (after_id, source, *statuses)
+        query = f"""
+            SELECT id, path, file_size FROM files
+            WHERE id > ?
+            AND source = ?
+            AND status IN ({', '.join('?' * len(statuses))})
+            AND duplicate_of IS NULL
+        """
+        if attempt_id is not None:
+            query += "AND last_attempt_id = ?"
+            params += (attempt_id,)
+        self.flush()
+        return self.conn.execute(query + " ORDER BY id LIMIT ?", (*params, limit)).fetchall()
+
+    def count_pending_files(self, source, include_errors: bool = True) -> int:
+        """
+        Get the number of pending files, except duplicates.
+        """
+        self.flush()
+        cursor = self.conn.cursor()
+        statuses = ('pending', 'error') if include_errors else ('pending',)
+        query = f"""
+            SELECT COUNT(*) FROM files
+            WHERE status IN ({', '.join('?' * len(statuses))})
+            AND source = ?
+            AND duplicate_of IS NULL
+        """
+        cursor.execute(query, (*statuses, source))
+        return cursor.fetchone()[0]
+
+    def claim_files(self, attempt_id: int, claim: str, limit: int) -> list[Tuple[int, str]]:
         """
-        Set the status of a file to uploaded and save the uploadcare UUID.
+        Claim up to `limit` unclaimed files of the attempt and return their IDs and paths.
+        The claim is made by a single statement, so concurrent workers never get the same file.
         """
         cursor = self.conn.cursor()
         cursor.execute(
             """
-            UPDATE files 
-            SET status = 'uploaded', 
-            error = NULL, 
-            uploadcare_uuid = ?, 
-            last_attempt_id = ?
-            WHERE path = ? 
-            AND source = ?
+            UPDATE files
+            SET claim = ?
+            WHERE id IN (
+                SELECT id FROM files
+                WHERE last_attempt_id = ?
+                AND claim IS NULL
+                AND status IN ('pending', 'error')
+                AND duplicate_of IS NULL
+                ORDER BY id
+                LIMIT ?
+            )
             """,
-            (uploadcare_uuid, attempt, path, source)
+            (claim, attempt_id, limit)
         )
         self.conn.commit()
+        cursor.execute("SELECT id, path FROM files WHERE claim = ? ORDER BY id", (claim,))
+        return cursor.fetchall()
+
+    def set_file_uploaded(self, file_id: int, attempt: int, uploadcare_uuid: str, retries: int = 0) -> None:
+        """
+        Set the status of a file to uploaded and save the uploadcare UUID
+        and the number of retries made, added to the ones of the previous attempts.
+        """
+        self.buffer_update('uploaded', (uploadcare_uuid, attempt, self.get_retries(file_id) + retries, file_id))
+
+    def set_file_error(self, file_id: int, error: str, retries: int = 0) -> None:
+        """
+        Set the status of a file to error and save the error message
+        and the number of retries made, added to the ones of the previous attempts.
+        """
+        self.buffer_update('error', (error, self.get_retries(file_id) + retries, file_id))
+
+    def get_retries(self, file_id: int) -> int:
+        """
+        Get the number of retries saved for a file.
+        """
+        row = self.conn.execute("SELECT retries FROM files WHERE id = ?", (file_id,)).fetchone()
+        return row[0] if row else 0
+
+    def buffer_update(self, kind: str, params: tuple) -> None:
+        """
+        Journal and buffer an update, flush the buffer if it's full or wasn't flushed for `flush_interval`.
+        """
+        if self.journal:
+            self.journal.append(kind, params)
+        self._buffer.append((kind, params))
+        if (len(self._buffer) >= self.buffer_size or
+                time.monotonic() - self._flushed_at >= self.flush_interval):
+            self.flush()
+
+    def flush_stale(self) -> None:
+        """
+        Write the buffered updates if the buffer wasn't flushed for `flush_interval`,
+        e.g. when the updates stall.
+        """
+        if self._buffer and time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered updates in one transaction.
+        """
+        self._flushed_at = time.monotonic()
+        if not self._buffer:
+            return
+        updates, self._buffer = self._buffer, []
+        self.apply_updates(updates)
+        if self.on_flush:
+            # The file ID is the last param of every update.
+            self.on_flush(self.get_report_rows(dict.fromkeys(params[-1] for _, params in updates)))
+        if self.journal:
+            self.journal.commit()
+            if self.journal.size >= self.compact_size:
+                self.compact_journal()
 
-    def set_file_error(self, path: str, source: str, error: str) -> None:
+    def apply_updates(self, updates: Iterable[Tuple[str, tuple]]) -> None:
         """
-        Set the status of a file to error and save the error message.
+        Apply file status updates in one transaction.
         """
         cursor = self.conn.cursor()
-        cursor.execute(
-            "UPDATE files SET status = 'error', error = ? WHERE path = ? AND source = ?",
-            (error, path, source)
-        )
+        for kind, group in groupby(updates, key=lambda update: update[0]):
+            cursor.executemany(UPDATES[kind], [params for _, params in group])
         self.conn.commit()
 
+    def get_report_rows(self, file_ids: Iterable[int], chunk_size: int = 500) -> List[tuple]:
+        """
+        Get paths, sizes, uploadcare UUIDs, statuses and errors of files by their IDs.
+        """
+        rows = []
+        file_ids = iter(file_ids)
+        while True:
+            chunk = list(islice(file_ids, chunk_size))
+            if not chunk:
+                return rows
+            rows.extend(self.conn.execute(
+                f"SELECT path, file_size, uploadcare_uuid, status, error FROM files "
+                f"WHERE id IN ({', '.join('?' * len(chunk))}) ORDER BY id",
+                chunk))
+
+    def get_journal_file(self, worker: Optional[int] = None) -> Path:
+        """
+        Get the journal file of the process.
+        """
+        worker = self.worker if worker is None else worker
+        suffix = '.journal' if worker is None else f'.{worker}.journal'
+        return self.db_file.with_suffix(suffix)
+
+    def replay_journals(self) -> None:
+        """
+        Apply the updates left in the journals by killed processes and remove the journals.
+        """
+        if self.worker is None:
+            journals = sorted(self.db_file.parent.glob(f'{self.db_file.stem}*.journal'))
+        else:
+            journals = [self.get_journal_file()]
+        for journal in journals:
+            if journal.exists():
+                updates = Journal.read(journal)
+                self.apply_updates(updates)
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                journal.unlink()
+                if updates and self.verbose:
+                    click.secho(f"Restored {len(updates)} file statuses from {journal}", fg='green')
+
+    def compact_journal(self) -> None:
+        """
+        Make the committed updates durable and remove them from the journal.
+        """
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.journal.truncate()
+
     def get_attempt_by_id(self, attempt_id: int) -> Tuple:
         """
         Get an attempt by ID.
@@ -233,7 +755,11 @@ class DBManager:
 
     def close_connection(self) -> None:
         """
-        Close the database connection.
+        Close the database connection, writing the buffered updates first.
         """
         if self.conn:
+            self.flush()
+            if self.journal:
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self.journal.close(remove=True)
             self.conn.close()
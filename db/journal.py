@@ -0,0 +1,105 @@
+"""
+
+    migro.db.journal
+    ~~~~~~~~~~~~~~~~
+
+    Append-only journal of file status updates.
+
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+
+class Journal:
+    """
+    Journal of file status updates not committed to the database yet.
+
+    Every update is written right away, so it survives the process being killed,
+    and synced to the disk in groups of `sync_size` updates or every `sync_interval`
+    seconds. A commit marker is written after the updates are committed to
+    the database, only the updates after the last marker are replayed.
+    """
+    COMMIT = 'commit'
+
+    def __init__(self, path: Path, sync_size: int = 100, sync_interval: float = 1.0):
+        self.path = path
+        self.sync_size = sync_size
+        self.sync_interval = sync_interval
+        self.file = open(path, 'a', encoding='utf-8')
+        self.size = 0
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    @classmethod
+    def read(cls, path: Path) -> List[Tuple[str, list]]:
+        """
+        Read the updates after the last commit marker.
+        A line cut off by a crash ends the journal.
+        """
+        updates = []
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    kind, *params = json.loads(line)
+                except ValueError:
+                    break
+                if kind == cls.COMMIT:
+                    updates = []
+                else:
+                    updates.append((kind, params))
+        return updates
+
+    def append(self, kind: str, params: tuple) -> None:
+        """
+        Write an update.
+        """
+        self.write([kind, *params])
+        if (self._unsynced >= self.sync_size or
+                time.monotonic() - self._synced_at >= self.sync_interval):
+            self.sync()
+
+    def commit(self) -> None:
+        """
+        Mark the updates written so far as committed to the database.
+        """
+        self.write([self.COMMIT])
+
+    def write(self, record: list) -> None:
+        """
+        Write a record to the journal file.
+        """
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.size += 1
+        self._unsynced += 1
+
+    def sync(self) -> None:
+        """
+        Sync the journal file to the disk.
+        """
+        if self._unsynced:
+            os.fsync(self.file.fileno())
+            self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def truncate(self) -> None:
+        """
+        Remove all the records, once they are all safely in the database.
+        """
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+        self.size = 0
+        self._unsynced = 0
+
+    def close(self, remove: bool = False) -> None:
+        """
+        Close the journal file, remove it if it's not needed anymore.
+        """
+        self.sync()
+        self.file.close()
+        if remove:
+            self.path.unlink()
@@ -19,7 +19,9 @@ parent = os.path.join(os.path.dirname(__file__), '..')
 sys.path.append(os.path.realpath(parent))
 
 from migro import __version__, settings
+from migro.reports import FORMATS
 from migro.uploader.fetcher import Fetcher
+from migro.uploader.inventory import Inventory, InventoryError
 
 # Find .env file
 ENV_FILE_PATH = Path(find_dotenv())
@@ -29,6 +31,30 @@ if not ENV_FILE_PATH or ENV_FILE_PATH == Path(''):
 ENV_FILE_PATH.touch(exist_ok=True)
 env = dotenv_values(ENV_FILE_PATH)
 
+# Common options of uploading commands and settings they override.
+COMMON_SETTINGS = {
+    'upload_base_url': 'UPLOAD_BASE',
+    'upload_timeout': 'FROM_URL_TIMEOUT',
+    'concurrent_uploads': 'MAX_CONCURRENT_UPLOADS',
+    'status_check_interval': 'STATUS_CHECK_INTERVAL',
+    'status_check_rate': 'STATUS_CHECK_RATE',
+    'status_check_connections': 'STATUS_CHECK_CONNECTIONS',
+    'auto_concurrency': 'AUTO_CONCURRENCY',
+    'requests_per_second': 'REQUESTS_PER_SECOND',
+    'max_retries': 'MAX_RETRIES',
+    'connection_pool_size': 'CONNECTION_POOL_SIZE',
+    'request_timeout': 'REQUEST_TIMEOUT',
+    'workers': 'WORKERS',
+    'report_format': 'REPORT_FORMAT',
+    'report_gzip': 'REPORT_GZIP',
+    'report_incremental': 'REPORT_INCREMENTAL',
+}
+
+
+def env_flag(key):
+    """Read boolean flag from the .env file."""
+    return str(env.get(key, '')).lower() in ('1', 'true', 'yes', 'on')
+
 
 def common_options(func):
     """Common options for all uploading commands."""
@@ -41,11 +67,42 @@ def common_options(func):
                   default=env.get('MAX_CONCURRENT_UPLOADS'))
     @click.option('--status_check_interval', help="Number of seconds in between status check requests.", type=float,
                   default=env.get('STATUS_CHECK_INTERVAL'))
+    @click.option('--status_check_rate', help="Maximum number of status check requests per second.", type=float,
+                  default=env.get('STATUS_CHECK_RATE'))
+    @click.option('--status_check_connections', help="Maximum number of status check requests running at once.",
+                  type=click.IntRange(min=1), default=env.get('STATUS_CHECK_CONNECTIONS'))
+    @click.option('--auto_concurrency', is_flag=True, default=env_flag('AUTO_CONCURRENCY'),
+                  help="Tune the number of concurrent uploads automatically, "
+                       "up to `--concurrent_uploads`.")
+    @click.option('--requests_per_second', help="Maximum number of upload API requests per second.", type=float,
+                  default=env.get('REQUESTS_PER_SECOND'))
+    @click.option('--max_retries', help="Maximum number of retries of a file after transient failures.", type=int,
+                  default=env.get('MAX_RETRIES'))
+    @click.option('--connection_pool_size', help="Maximum number of connections to the upload API.", type=int,
+                  default=env.get('CONNECTION_POOL_SIZE'))
+    @click.option('--request_timeout', help="Number of seconds to wait for an upload API response.", type=float,
+                  default=env.get('REQUEST_TIMEOUT'))
+    @click.option('--workers', help="Number of uploader processes.", type=click.IntRange(min=1),
+                  default=env.get('WORKERS'))
+    @click.option('--report_format', help="Format of the attempt report.", type=click.Choice(FORMATS),
+                  default=env.get('REPORT_FORMAT'))
+    @click.option('--report_gzip', is_flag=True, default=env_flag('REPORT_GZIP'),
+                  help="Compress the attempt report with gzip.")
+    @click.option('--report_incremental', is_flag=True, default=env_flag('REPORT_INCREMENTAL'),
+                  help="Write the attempt report as files are finished, not at the end.")
     def new_func(*args, **kwargs):
         return func(*args, **kwargs)
     return new_func
 
 
+def apply_common_options(options):
+    """Override settings with the common options specified."""
+    for option, setting in COMMON_SETTINGS.items():
+        value = options.get(option)
+        if value is not None:
+            setattr(settings, setting, value)
+
+
 def update_dotenv(key, value, env_file_path):
     with open(env_file_path, 'r') as file:
         lines = file.readlines()
@@ -78,6 +135,29 @@ def validate_s3_bucket(ctx, param, value):
     return value
 
 
+def parse_shard(ctx, param, value):
+    """Parse `i/N` shard into zero-based index and count."""
+    if value is None:
+        return None
+    try:
+        number, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise click.BadParameter('Shard must be given as i/N, e.g. 1/4.')
+    if not 1 <= number <= count:
+        raise click.BadParameter('Shard number must be from 1 to the number of shards.')
+    return number - 1, count
+
+
+def load_inventory(ctx, param, value):
+    """Read S3 Inventory report manifest."""
+    if value is None:
+        return None
+    try:
+        return Inventory(value)
+    except InventoryError as e:
+        raise click.BadParameter(str(e))
+
+
 def show_version(ctx, param, value):
     """Show version and quit."""
     if value and not ctx.resilient_parsing:
@@ -135,6 +215,16 @@ def cli(ctx):
     help="Your S3 region.",
     type=str
 )
+@click.option(
+    '--s3_listing_threads',
+    help="Number of threads listing the bucket.",
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--s3_partitions',
+    help="Comma-separated key prefixes to split the bucket listing by.",
+    type=str
+)
 @click.option(
     '--uc_public_key',
     help="Your Uploadcare public key.",
@@ -165,8 +255,63 @@ def cli(ctx):
     help="Number of seconds in between status check requests.",
     type=float
 )
-def init(s3_access_key_id, s3_secret_access_key, s3_bucket_name, s3_region, uc_public_key, uc_secret_key,
-         upload_base_url, upload_timeout, concurrent_uploads, status_check_interval):
+@click.option(
+    '--status_check_rate',
+    help="Maximum number of status check requests per second.",
+    type=float
+)
+@click.option(
+    '--status_check_connections',
+    help="Maximum number of status check requests running at once.",
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--auto_concurrency/--no_auto_concurrency',
+    help="Tune the number of concurrent uploads automatically.",
+    default=None
+)
+@click.option(
+    '--requests_per_second',
+    help="Maximum number of upload API requests per second.",
+    type=float
+)
+@click.option(
+    '--max_retries',
+    help="Maximum number of retries of a file after transient failures.",
+    type=int
+)
+@click.option(
+    '--connection_pool_size',
+    help="Maximum number of connections to the upload API.",
+    type=int
+)
+@click.option(
+    '--request_timeout',
+    help="Number of seconds to wait for an upload API response.",
+    type=float
+)
+@click.option(
+    '--workers',
+    help="Number of uploader processes.",
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--report_format',
+    help="Format of the attempt report.",
+    type=click.Choice(FORMATS)
+)
+@click.option(
+    '--report_gzip/--no_report_gzip',
+    help="Compress the attempt report with gzip.",
+    default=None
+)
+@click.option(
+    '--report_incremental/--no_report_incremental',
+    help="Write the attempt report as files are finished, not at the end.",
+    default=None
+)
+def init(s3_access_key_id, s3_secret_access_key, s3_bucket_name, s3_region, s3_listing_threads, s3_partitions,
+         uc_public_key, uc_secret_key, **common):
     """Initialize .env file with credentials and other settings."""
 
     options = {
@@ -174,13 +319,12 @@ def init(s3_access_key_id, s3_secret_access_key, s3_bucket_name, s3_region, uc_p
         'S3_SECRET_ACCESS_KEY': s3_secret_access_key,
         'S3_BUCKET_NAME': s3_bucket_name,
         'S3_REGION': s3_region,
+        'S3_LISTING_THREADS': s3_listing_threads,
+        'S3_PARTITIONS': s3_partitions,
         'PUBLIC_KEY': uc_public_key,
         'SECRET_KEY': uc_secret_key,
-        'UPLOAD_BASE': upload_base_url,
-        'FROM_URL_TIMEOUT': upload_timeout,
-        'MAX_CONCURRENT_UPLOADS': concurrent_uploads,
-        'STATUS_CHECK_INTERVAL': status_check_interval
     }
+    options.update({COMMON_SETTINGS[option]: value for option, value in common.items()})
 
     for key, value in options.items():
         if value is not None:
@@ -194,14 +338,11 @@ def init(s3_access_key_id, s3_secret_access_key, s3_bucket_name, s3_region, uc_p
 @click.argument('pub_key', type=str, required=False, default=env.get('PUBLIC_KEY'), callback=validate_uc_public_key)
 @click.argument('secret_key', type=str, required=False, default=env.get('SECRET_KEY'))
 @common_options
-def urls(file, pub_key, secret_key, upload_base_url, upload_timeout, concurrent_uploads, status_check_interval):
+def urls(file, pub_key, secret_key, **common):
     """Migrate files from a file with URLs to Uploadcare."""
     settings.PUBLIC_KEY = pub_key
     settings.SECRET_KEY = secret_key
-    settings.UPLOAD_BASE = upload_base_url or settings.UPLOAD_BASE
-    settings.FROM_URL_TIMEOUT = upload_timeout or settings.FROM_URL_TIMEOUT
-    settings.MAX_CONCURRENT_UPLOADS = concurrent_uploads or settings.MAX_CONCURRENT_UPLOADS
-    settings.STATUS_CHECK_INTERVAL = status_check_interval or settings.STATUS_CHECK_INTERVAL
+    apply_common_options(common)
 
     fetcher = Fetcher()
     fetcher.upload_urls(file)
@@ -217,9 +358,30 @@ def urls(file, pub_key, secret_key, upload_base_url, upload_timeout, concurrent_
               help="Your AWS S3 secret access key.")
 @click.option('--s3_region', type=str, default=env.get('S3_REGION'),
               help="Your S3 region.")
+@click.option('--s3_listing_threads', type=click.IntRange(min=1), default=env.get('S3_LISTING_THREADS'),
+              help="Number of threads listing the bucket.")
+@click.option('--s3_partitions', type=str, default=env.get('S3_PARTITIONS'),
+              help="Comma-separated key prefixes to split the bucket listing by, "
+                   "all the keys must start with one of them.")
+@click.option('--inventory', type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True),
+              callback=load_inventory,
+              help="Local S3 Inventory report manifest.json to take the files from "
+                   "instead of listing the bucket.")
+@click.option('--prefix', type=str, default='', help="Upload only the keys with this prefix.")
+@click.option('--include', type=str, multiple=True,
+              help="Upload only the keys matching this shell-style pattern, can be repeated.")
+@click.option('--exclude', type=str, multiple=True,
+              help="Skip the keys matching this shell-style pattern, can be repeated.")
+@click.option('--min_size', type=click.IntRange(min=0), help="Minimum size of the files to upload, bytes.")
+@click.option('--max_size', type=click.IntRange(min=0), help="Maximum size of the files to upload, bytes.")
+@click.option('--modified_since', type=click.DateTime(['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S']),
+              help="Upload only the files modified since this UTC date or time.")
+@click.option('--shard', type=str, callback=parse_shard,
+              help="Upload only shard i of N the keys are split into by their hash, e.g. 1/4.")
 @common_options
 def s3(bucket_name, pub_key, secret_key, s3_access_key_id, s3_secret_access_key, s3_region,
-       upload_base_url, upload_timeout, concurrent_uploads, status_check_interval):
+       s3_listing_threads, s3_partitions, inventory, prefix, include, exclude, min_size, max_size,
+       modified_since, shard, **common):
     """Migrate files from an S3 bucket to Uploadcare."""
     settings.PUBLIC_KEY = pub_key
     settings.SECRET_KEY = secret_key
@@ -227,13 +389,21 @@ def s3(bucket_name, pub_key, secret_key, s3_access_key_id, s3_secret_access_key,
     settings.S3_ACCESS_KEY_ID = s3_access_key_id
     settings.S3_SECRET_ACCESS_KEY = s3_secret_access_key
     settings.S3_REGION = s3_region
-    settings.UPLOAD_BASE = upload_base_url or settings.UPLOAD_BASE
-    settings.FROM_URL_TIMEOUT = upload_timeout or settings.FROM_URL_TIMEOUT
-    settings.MAX_CONCURRENT_UPLOADS = concurrent_uploads or settings.MAX_CONCURRENT_UPLOADS
-    settings.STATUS_CHECK_INTERVAL = status_check_interval or settings.STATUS_CHECK_INTERVAL
+    if s3_listing_threads is not None:
+        settings.S3_LISTING_THREADS = s3_listing_threads
+    if s3_partitions:
+        settings.S3_PARTITIONS = [partition.strip() for partition in s3_partitions.split(',')]
+    settings.S3_PREFIX = prefix
+    settings.S3_INCLUDE = list(include)
+    settings.S3_EXCLUDE = list(exclude)
+    settings.S3_MIN_SIZE = min_size
+    settings.S3_MAX_SIZE = max_size
+    settings.S3_MODIFIED_SINCE = modified_since
+    settings.S3_SHARD = shard
+    apply_common_options(common)
 
     fetcher = Fetcher()
-    fetcher.upload_s3()
+    fetcher.upload_s3(inventory)
 
 
 @cli.command()
@@ -0,0 +1,83 @@
+"""
+
+    migro.reports
+    ~~~~~~~~~~~~~
+
+    Attempt reports.
+
+"""
+import csv
+import gzip
+import json
+from datetime import datetime
+from pathlib import Path
+
+from migro import settings
+
+HEADER = ['Path', 'File Size', 'Uploadcare UUID', 'Status', 'Error']
+KEYS = ['path', 'file_size', 'uuid', 'status', 'error']
+FORMATS = ('csv', 'jsonl')
+
+
+def get_report_file(attempt_id, source, format='csv', compress=False):
+    """Get report file of the attempt in the logs folder."""
+    path = Path(__file__).resolve().parent.parent / "logs"
+    path.mkdir(exist_ok=True)
+    current_time = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+    extension = f'{format}.gz' if compress else format
+    return path / f"Attempt {attempt_id} - {current_time} - {source}.{extension}"
+
+
+class Report:
+    """Attempt report, written row by row, so the rows are never all in memory.
+
+    :param filename: Report file.
+    :param format: Report format, `csv` or `jsonl`.
+    :param compress: Whether to gzip the report.
+
+    """
+    def __init__(self, filename, format='csv', compress=False):
+        if format not in FORMATS:
+            raise ValueError(f'Unknown report format: {format}')
+        self.filename = filename
+        self.format = format
+        opener = gzip.open if compress else open
+        self.file = opener(filename, 'wt', newline='', encoding='utf-8')
+        if format == 'csv':
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(HEADER)
+
+    def write(self, rows):
+        """Write rows of path, file size, Uploadcare UUID, status and error."""
+        if self.format == 'csv':
+            self.writer.writerows(rows)
+        else:
+            self.file.writelines(json.dumps(dict(zip(KEYS, row))) + '\n' for row in rows)
+        return None
+
+    def flush(self):
+        self.file.flush()
+        return None
+
+    def close(self):
+        self.file.close()
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_report(attempt_id, source):
+    """Open report of the attempt in the configured format."""
+    filename = get_report_file(attempt_id, source, settings.REPORT_FORMAT, settings.REPORT_GZIP)
+    return Report(filename, settings.REPORT_FORMAT, settings.REPORT_GZIP)
+
+
+def save_report(files, attempt_id, source):
+    """Save report of the attempt streaming `files` rows from a cursor."""
+    with open_report(attempt_id, source) as report:
+        report.write(files)
+    return report.filename
@@ -22,12 +22,96 @@ FROM_URL_TIMEOUT = 30
 # Maximum number of concurrent upload requests
 MAX_CONCURRENT_UPLOADS = 20
 
+# Tune the number of concurrent upload requests automatically,
+# `MAX_CONCURRENT_UPLOADS` is used as the starting point and the ceiling.
+AUTO_CONCURRENCY = False
+
+# Minimum number of concurrent upload requests in auto-tuning mode.
+MIN_CONCURRENT_UPLOADS = 1
+
+# Maximum number of files waiting for `from_url` status at once.
+MAX_CONCURRENT_STATUS_CHECKS = 1000
+
+# Maximum number of events passed to a batch callback at once.
+EVENTS_BATCH_SIZE = 100
+
+# Interval to pass collected events to batch callbacks, seconds.
+EVENTS_FLUSH_INTERVAL = 0.5
+
+# Size of the queues handing files off between the upload stages.
+# It also limits how many input files are read ahead.
+STAGE_QUEUE_SIZE = 1000
+
+# Number of uploader processes. Every process claims batches of
+# `WORKER_BATCH_SIZE` pending files from the database.
+WORKERS = 1
+
+# Number of files claimed by a worker process at once.
+WORKER_BATCH_SIZE = 100
+
 # Time to wait before next status check, seconds.
 STATUS_CHECK_INTERVAL = 0.3
 
+# Maximum time to wait before next status check, seconds.
+# Checks of a file that makes no progress are backed off
+# from `STATUS_CHECK_INTERVAL` up to this value.
+STATUS_CHECK_MAX_INTERVAL = 5.0
+
+# Status check interval multiplier applied while a file makes no progress.
+STATUS_CHECK_BACKOFF = 1.5
+
+# Maximum number of status check requests per second, for all files.
+# It's raised to check every file waiting for its status at least once
+# per `STATUS_CHECK_MAX_INTERVAL`, so it never limits how fast files finish.
+STATUS_CHECK_RATE = 1000
+
+# Maximum number of status check requests running at once.
+STATUS_CHECK_CONNECTIONS = 10
+
 # Throttling timeout sleep interval
 THROTTLING_TIMEOUT = 5.0
 
+# Maximum number of upload API requests per second, unlimited if not set.
+REQUESTS_PER_SECOND = None
+
+# Upload API connection pool size. If not set, it has a connection for
+# every upload request and every status check running at once:
+# `MAX_CONCURRENT_UPLOADS` + `STATUS_CHECK_CONNECTIONS`.
+CONNECTION_POOL_SIZE = None
+
+# Number of seconds to keep an idle connection open.
+KEEPALIVE_TIMEOUT = 30.0
+
+# Number of seconds to cache resolved host names for.
+DNS_CACHE_TTL = 300
+
+# Total upload API request timeout, seconds.
+REQUEST_TIMEOUT = 60.0
+
+# Upload API connection timeout, seconds.
+CONNECT_TIMEOUT = 10.0
+
+# Maximum number of retries of a file after transient failures:
+# network errors, 5xx responses and status check timeouts.
+MAX_RETRIES = 3
+
+# Base delay before a retry, seconds. It is doubled for every next retry
+# and randomized (full jitter).
+RETRY_BACKOFF = 1.0
+
+# Maximum delay before a retry, seconds.
+RETRY_MAX_BACKOFF = 60.0
+
+# Attempt report format: `csv` or `jsonl`.
+REPORT_FORMAT = 'csv'
+
+# Compress the attempt report with gzip.
+REPORT_GZIP = False
+
+# Write the attempt report during the run, as files are finished,
+# instead of at the end.
+REPORT_INCREMENTAL = False
+
 # S3 access key ID.
 S3_ACCESS_KEY_ID = None
 
@@ -40,5 +124,36 @@ S3_BUCKET_NAME = None
 # S3 region.
 S3_REGION = None
 
-# S3 signed URL expiration time, seconds.
-S3_URL_EXPIRATION_TIME = 86400
+# Number of threads listing the bucket.
+S3_LISTING_THREADS = 8
+
+# Prefixes to split the bucket listing by, relative to `S3_PREFIX`, all the keys
+# must start with one of them. If not set, they're discovered from "/"-delimited
+# key prefixes.
+S3_PARTITIONS = None
+
+# Maximum number of prefix levels to discover the listing partitions in.
+S3_DISCOVERY_DEPTH = 2
+
+# Prefix of the keys to upload, only the keys under it are listed.
+S3_PREFIX = ''
+
+# Shell-style patterns the keys to upload must match any of, if set,
+# and must not match any of. `*` matches `/` too.
+S3_INCLUDE = None
+S3_EXCLUDE = None
+
+# Sizes of the files to upload, bytes.
+S3_MIN_SIZE = None
+S3_MAX_SIZE = None
+
+# Upload files modified since this UTC datetime only.
+S3_MODIFIED_SINCE = None
+
+# Shard of the keys to upload, (index, count): keys are split into `count`
+# shards by their hash, the same on every machine, only shard `index` is uploaded.
+S3_SHARD = None
+
+# S3 signed URL expiration time, seconds. URLs are signed right before
+# they are submitted, so they only need to last till Uploadcare downloads the file.
+S3_URL_EXPIRATION_TIME = 3600
@@ -0,0 +1,156 @@
+"""
+
+    migro.uploader.client
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Upload API client.
+
+"""
+import time
+from urllib.parse import urljoin
+
+from migro import __version__ as version
+from migro import settings
+from migro.uploader.rate_limit import RateLimiter
+from migro.uploader.transport import Transport
+from migro.uploader.utils import generate_secure_signature, get_retry_after
+
+
+class UploadAPIClient:
+    """Upload API client, created once per run.
+
+    Everything that doesn't change from request to request is prepared
+    beforehand: request URLs, headers and the key params. The signature
+    for signed uploads is reused till `signature_margin` seconds before
+    it expires.
+
+    :param public_key: Project public key.
+    :param secret_key: Project secret key, for signed uploads only.
+    :param base_url: Upload API base URL.
+    :param transport: HTTP transport.
+    :param rate_limiter: Rate limiter shared by all the requests.
+    :param signature_lifetime: Signature lifetime, minutes.
+    :param signature_margin: Seconds before expiration to renew the signature.
+    :param clock: Time source.
+
+    """
+    def __init__(self, public_key, secret_key=None, base_url=None,
+                 transport=None, rate_limiter=None, signature_lifetime=5,
+                 signature_margin=60, clock=time.time):
+        self.public_key = public_key
+        self.secret_key = secret_key
+        self.base_url = base_url or settings.UPLOAD_BASE
+        self.transport = transport or Transport()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.signature_lifetime = signature_lifetime
+        self.signature_margin = signature_margin
+        self.clock = clock
+
+        self.headers = {
+            "User-Agent": f"Migro/{version}/{public_key}"
+        }
+        self._params = {
+            'pub_key': public_key,
+            'UPLOADCARE_PUB_KEY': public_key,
+        }
+        self._urls = {}
+        self._expire = None
+
+    @classmethod
+    def from_settings(cls, **kwargs):
+        """Create client configured with `migro.settings`.
+
+        :param kwargs: Overrides of the client arguments.
+
+        :return: UploadAPIClient.
+
+        """
+        options = {
+            'public_key': settings.PUBLIC_KEY,
+            'secret_key': settings.SECRET_KEY,
+            'base_url': settings.UPLOAD_BASE,
+            'rate_limiter': RateLimiter(settings.REQUESTS_PER_SECOND),
+        }
+        options.update(kwargs)
+        return cls(**options)
+
+    def url(self, path):
+        """Get request URL for `path`.
+
+        :param path: Request path.
+
+        :return: str.
+
+        """
+        url = self._urls.get(path)
+        if url is None:
+            url = self._urls[path] = urljoin(self.base_url, path.lstrip('/'))
+        return url
+
+    def params(self, params=None):
+        """Get request params with the keys and the current signature.
+
+        :param params: Request specific params.
+
+        :return: dict.
+
+        """
+        if self.secret_key and (self._expire is None or
+                                self._expire - self.clock() < self.signature_margin):
+            self._expire = int(self.clock()) + 60 * self.signature_lifetime
+            self._params['signature'] = generate_secure_signature(self.secret_key, self._expire)
+            self._params['expire'] = self._expire
+
+        result = dict(self._params)
+        if params:
+            result.update(params)
+        return result
+
+    async def request(self, path, params=None):
+        """Makes GET upload API request with specific path and params.
+
+        All the requests pass the shared rate limiter, a throttled response
+        pauses all of them for `Retry-After` seconds.
+
+        :param path: Request path.
+        :param params: Request params.
+
+        :return: migro.uploader.transport.Response.
+
+        """
+        await self.rate_limiter.acquire()
+        response = await self.transport.request(
+            method='get',
+            url=self.url(path),
+            headers=self.headers,
+            allow_redirects=True,
+            params=self.params(params))
+        if response.status == 429:
+            self.rate_limiter.pause(get_retry_after(response))
+        return response
+
+    async def from_url(self, source_url, store='auto'):
+        """Request upload of a file from `source_url`.
+
+        :param source_url: File URL.
+        :param store: Whether to store the uploaded file.
+
+        :return: migro.uploader.transport.Response.
+
+        """
+        return await self.request('from_url/', {'source_url': source_url, 'store': store})
+
+    async def from_url_status(self, token):
+        """Request status of `from_url` upload.
+
+        :param token: Upload token.
+
+        :return: migro.uploader.transport.Response.
+
+        """
+        return await self.request('from_url/status/', {'token': token})
+
+    async def close(self):
+        """Close the client connections."""
+        await self.transport.close()
+        return None
@@ -0,0 +1,145 @@
+"""
+
+    migro.uploader.concurrency
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Adaptive concurrency limiter.
+
+"""
+import asyncio
+from collections import deque
+
+
+class ConcurrencyLimiter:
+    """Concurrency limit for upload requests, optionally auto-tuned with
+    additive increase / multiplicative decrease (AIMD).
+
+    In adaptive mode the limit grows by `increase` after every `limit`
+    successful requests while their latency stays close to the best one
+    seen, and is cut by `decrease` factor when requests are throttled or
+    when errors make up more than `error_threshold` of recent requests.
+    The limit never goes beyond `minimum`..`maximum` range.
+
+    :param limit: Starting limit.
+    :param minimum: Lowest possible limit.
+    :param maximum: Highest possible limit, `limit` if omitted.
+    :param adaptive: Whether to tune the limit at all.
+    :param increase: Additive increase step.
+    :param decrease: Multiplicative decrease factor.
+    :param latency_tolerance: How many times latency may exceed
+        the baseline to still be considered stable.
+    :param error_threshold: Share of failed recent requests treated as a spike.
+    :param window: Number of recent requests to count errors in.
+    :param loop: Limiter event loop.
+
+    """
+    def __init__(self, limit, minimum=1, maximum=None, adaptive=False,
+                 increase=1, decrease=0.5, latency_tolerance=2.0,
+                 error_threshold=0.5, window=20, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.maximum = maximum or limit
+        self.minimum = min(minimum, self.maximum)
+        self.limit = max(min(limit, self.maximum), self.minimum)
+        self.adaptive = adaptive
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.error_threshold = error_threshold
+
+        self.in_flight = 0
+        self._waiters = deque()
+        self._successes = 0
+        self._latency = None
+        self._baseline = None
+        self._outcomes = deque(maxlen=window)
+        self._last_decrease = None
+
+    async def acquire(self):
+        """Wait for a free slot and take it."""
+        while self.in_flight >= self.limit:
+            waiter = self.loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        self.in_flight += 1
+        return None
+
+    def release(self):
+        """Give the slot back."""
+        self.in_flight -= 1
+        self._wake_up()
+        return None
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def succeeded(self, latency):
+        """Record a successful request which took `latency` seconds."""
+        if not self.adaptive:
+            return None
+        self._outcomes.append(True)
+
+        if self._latency is None:
+            self._latency = self._baseline = latency
+        else:
+            self._latency = 0.8 * self._latency + 0.2 * latency
+            # Let the baseline slowly follow the network changes.
+            self._baseline = min(self._baseline * 1.01, self._latency)
+
+        if self._latency <= self._baseline * self.latency_tolerance:
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                self.limit = min(self.limit + self.increase, self.maximum)
+                self._wake_up()
+        return None
+
+    def failed(self):
+        """Record a failed request."""
+        if not self.adaptive:
+            return None
+        self._outcomes.append(False)
+
+        errors = self._outcomes.count(False)
+        if len(self._outcomes) >= self._outcomes.maxlen // 2 \
+                and errors > len(self._outcomes) * self.error_threshold:
+            self._outcomes.clear()
+            self._cut()
+        return None
+
+    def throttled(self):
+        """Record a throttled request."""
+        if not self.adaptive:
+            return None
+        self._cut()
+        return None
+
+    def _cut(self):
+        now = self.loop.time()
+        # Requests sent before the previous cut are still reporting,
+        # don't punish the same overload twice.
+        cooldown = self._latency or 1.0
+        if self._last_decrease is not None and now - self._last_decrease < cooldown:
+            return None
+        self._last_decrease = now
+        self._successes = 0
+        self.limit = max(int(self.limit * self.decrease), self.minimum)
+        return None
+
+    def _wake_up(self):
+        free = self.limit - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
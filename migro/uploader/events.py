@@ -0,0 +1,174 @@
+"""
+
+    migro.uploader.events
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Uploader events and their dispatching.
+
+"""
+import asyncio
+from collections import defaultdict
+from enum import Enum
+
+
+class Events(Enum):
+    """Available events."""
+    UPLOAD_ERROR = 'UPLOAD_ERROR'
+    UPLOAD_THROTTLED = 'UPLOAD_THROTTLED'
+    UPLOAD_COMPLETE = 'UPLOAD_COMPLETE'
+    # Transient failure, the file will be uploaded again.
+    UPLOAD_RETRY = 'UPLOAD_RETRY'
+    # Download on Uploadcare side.
+    DOWNLOAD_ERROR = 'DOWNLOAD_ERROR'
+    DOWNLOAD_COMPLETE = 'DOWNLOAD_COMPLETE'
+
+    def __str__(self):
+        return self.value
+
+
+class Event:
+    """An event of a file.
+
+    Supports mapping access too: ``event['file']``.
+
+    :param type: `Events` member.
+    :param file: `File` instance.
+
+    """
+    __slots__ = ('type', 'file')
+
+    def __init__(self, type, file):
+        self.type = type
+        self.file = file
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+
+class Batch:
+    """Events buffer of a batch callback.
+
+    :param callback: Callback called with a list of events.
+    :param size: Number of events to call the callback with.
+
+    """
+    __slots__ = ('callback', 'size', 'events')
+
+    def __init__(self, callback, size):
+        self.callback = callback
+        self.size = size
+        self.events = []
+
+    def add(self, event):
+        self.events.append(event)
+        if len(self.events) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.events:
+            events, self.events = self.events, []
+            self.callback(events)
+
+
+class EventBus:
+    """Dispatches events to callbacks right when they're emitted.
+
+    Plain callbacks are called synchronously, coroutine callbacks are
+    scheduled in `loop`. Batch callbacks get lists of events, when
+    `size` events are collected or on `flush`.
+
+    :param events: Set of available events.
+    :param loop: Event loop for coroutine callbacks.
+
+    """
+    def __init__(self, events, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.events = events
+        self.loop = loop
+        self._callbacks = defaultdict(list)
+        self._batches = defaultdict(list)
+
+    def emit(self, event_type, file):
+        """Dispatch `event_type` event of `file`.
+
+        :param event_type: `Events` member.
+        :param file: `File` instance.
+
+        """
+        event = Event(event_type, file)
+        for callback, is_coroutine in self._callbacks.get(event_type, ()):
+            if is_coroutine:
+                asyncio.ensure_future(callback(event), loop=self.loop)
+            else:
+                callback(event)
+        for batch in self._batches.get(event_type, ()):
+            batch.add(event)
+        return None
+
+    def flush(self):
+        """Call batch callbacks with all the collected events."""
+        batches = dict.fromkeys(batch for batches in self._batches.values() for batch in batches)
+        for batch in batches:
+            batch.flush()
+        return None
+
+    def on(self, *events, callback):
+        """Register `callback` for `events`.
+
+        :param events: Events to listen.
+        :param callback: Callback to register.
+
+        """
+        self._check(events)
+        is_coroutine = asyncio.iscoroutinefunction(callback)
+        for event in events:
+            self._callbacks[event].append((callback, is_coroutine))
+        return None
+
+    def on_batch(self, *events, callback, size=100):
+        """Register batch `callback` for `events`.
+
+        Events of all the `events` types are collected into one list,
+        in the order they're emitted.
+
+        :param events: Events to listen.
+        :param callback: Callback to register, takes a list of events.
+        :param size: Maximum number of events in a batch.
+
+        """
+        self._check(events)
+        batch = Batch(callback, size)
+        for event in events:
+            self._batches[event].append(batch)
+        return None
+
+    def off(self, *events, callback=None):
+        """Unregister specific callback or all callbacks for `events`.
+
+        :param events: Events to stop listening.
+        :param callback: Callback to unregister.
+
+        """
+        self._check(events)
+        for event in events:
+            removed = [batch for batch in self._batches.get(event, ())
+                       if callback is None or batch.callback == callback]
+            for batch in removed:
+                # Don't lose the events collected so far.
+                batch.flush()
+                self._batches[event].remove(batch)
+            if callback:
+                self._callbacks[event] = [
+                    item for item in self._callbacks[event] if item[0] != callback]
+            else:
+                self._callbacks.pop(event, None)
+        return None
+
+    def _check(self, events):
+        for event in events:
+            if event not in self.events:
+                raise TypeError('Unknown event')
@@ -7,26 +7,35 @@
 
 """
 import asyncio
+import csv
+import threading
+from contextlib import closing
 
 import click
 from tqdm import tqdm
 
+from db.async_db_manager import AsyncDBManager
 from db.db_manager import DBManager, get_db_file
+from migro import settings
 from migro.filestack.utils import build_url
+from migro.reports import open_report, save_report
+from migro.uploader.client import UploadAPIClient
+from migro.uploader.inventory import InventoryError
+from migro.uploader.processes import WorkerPool
 from migro.uploader.s3_client import (AccessDeniedError, S3Client,
                                       UnexpectedError)
-from migro.uploader.utils import loop, session
-from migro.uploader.worker import Events, Uploader
-from migro.utils import save_result_to_csv
+from migro.uploader.utils import loop
+from migro.uploader.worker import Events, File, Uploader
 
 
 def db(func):
     """Decorator for properly connecting and disconnecting to the database."""
     def wrapper(self, *args, **kwargs):
         self.connect_db()
-        result = func(self, *args, **kwargs)
-        self.disconnect_db()
-        return result
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.disconnect_db()
 
     return wrapper
 
@@ -38,15 +47,21 @@ class Fetcher:
         'S3': 's3'
     }
 
-    def __init__(self):
+    def __init__(self, worker=None):
+        self.worker = worker
         self.db_manager = None
+        self.db = None
         self.attempt = None
+        self.report = None
         self.bar = None
         self.source = None
         self.s3_client = None
-        self.s3_signed_urls = None
-        self.uploader = Uploader(loop=loop)
-        self.uploader.on(
+        self.listing = None
+        self.listing_error = None
+        self.listing_stopped = threading.Event()
+        self.client = UploadAPIClient.from_settings()
+        self.uploader = Uploader(loop=loop, client=self.client)
+        self.uploader.on_batch(
             Events.DOWNLOAD_COMPLETE,
             Events.UPLOAD_ERROR,
             Events.DOWNLOAD_ERROR,
@@ -60,34 +75,166 @@ class Fetcher:
     def launch_loop(self, files):
         """Launch the loop for processing files."""
         cancelled = False
+        flushing = asyncio.ensure_future(self.db.flush_periodically(), loop=loop)
 
         try:
             loop.run_until_complete(self.uploader.process(files))
         except (KeyboardInterrupt, asyncio.CancelledError):
             cancelled = True
         finally:
-            self.bar.close()
-            asyncio.ensure_future(session.close())
+            flushing.cancel()
             self.uploader.shutdown()
-            result = self.db_manager.finish_attempt(self.attempt)
-            file = save_result_to_csv(*result[:2], self.source)
-            self.show_final_messages(file, *result[2:])
+            loop.run_until_complete(self.client.close())
+            self.stop_listing()
+            self.db.join()
+            self.finish_upload()
 
         loop.close()
 
         if cancelled:
             click.echo('\n\nFile uploading has been cancelled!')
 
-    def start_upload(self):
-        """Start the file uploading."""
+    def launch_workers(self, workers):
+        """Launch `workers` processes for processing files of the attempt."""
+        cancelled = False
+        pool = WorkerPool(workers, self.source, self.attempt,
+                          report=self.write_report if self.report else None)
+
+        try:
+            pool.start()
+            pool.wait(self.bar)
+        except KeyboardInterrupt:
+            cancelled = True
+        finally:
+            # Interrupted workers save their results before exiting.
+            pool.stop(self.bar)
+            self.finish_upload()
+
+        loop.close()
+
+        if cancelled:
+            click.echo('\n\nFile uploading has been cancelled!')
+
+    def finish_upload(self):
+        """Finish the attempt and save its results."""
+        self.bar.close()
+        result = self.db_manager.finish_attempt(self.attempt)
+        if self.report:
+            self.db_manager.on_flush = None
+            self.report.close()
+            file = self.report.filename
+        else:
+            file = save_report(*result[:2], self.source)
+        self.show_final_messages(file, *result[2:])
+        if self.listing_error:
+            click.secho(f'Failed to list the bucket: {self.listing_error}', fg='red')
+            click.secho('Run the command again to resume the listing.', fg='red')
+
+    def write_report(self, rows):
+        """Write rows of the files finished since the last time to the report."""
+        self.report.write(rows)
+        self.report.flush()
+
+    async def iter_pending(self, chunk_size=1000):
+        """Iterate over IDs and paths of pending files of the attempt.
+
+        While the bucket is being listed, wait for the files inserted
+        after the ones read so far.
+        """
+        last_id = 0
+        while True:
+            # Check before reading, so the files of the last page aren't missed.
+            listing = self.listing is not None and self.listing.is_alive()
+            rows = await self.db.run(
+                self.db_manager.get_pending_files_page, self.source, last_id, chunk_size,
+                attempt_id=self.attempt)
+            for file_id, path, _ in rows:
+                yield file_id, path
+            if rows:
+                last_id = rows[-1][0]
+            elif listing:
+                await asyncio.sleep(0.5)
+            else:
+                return
+
+    async def iter_upload_files(self, rows):
+        """Iterate over files to upload for `rows` async iterable of IDs and paths.
+
+        S3 keys are signed by the uploader right before they are submitted.
+        """
+        async for file_id, path in rows:
+            yield File(path, id=file_id)
+
+    def iter_claimed_files(self, number):
+        """Iterate over IDs and paths of files claimed by worker `number` batch by batch."""
+        batch = 0
+        while True:
+            claim = f'{self.attempt}:{number}:{batch}'
+            rows = self.db_manager.claim_files(self.attempt, claim, settings.WORKER_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+            batch += 1
+
+    def list_bucket(self):
+        """List the bucket into the database, resuming the interrupted listing.
+
+        Files are inserted page by page, added to the attempt if it's started.
+        Listing errors are kept to be shown at the end.
+        """
+        bucket = self.s3_client.listing_name
+        tasks = self.db.call(self.db_manager.get_listing, bucket)
+        if tasks:
+            tqdm.write('Resuming the interrupted bucket listing...')
+        else:
+            tasks = self.db.call(self.db_manager.start_listing, bucket, self.s3_client.get_partitions())
+        duplicates = 0
+        try:
+            with closing(self.s3_client.iter_listing(tasks)) as pages:
+                for page in pages:
+                    if self.listing_stopped.is_set():
+                        break
+                    if page.last:
+                        self.db.call(self.db_manager.finish_listing, bucket, page.prefix)
+                        continue
+                    count, page_duplicates = self.db.call(
+                        self.db_manager.insert_listed_files, self.source, bucket, page.prefix,
+                        page.objects, page.prefixes, page.last_key, self.attempt)
+                    duplicates += page_duplicates
+                    if self.bar is not None and count:
+                        self.bar.total += count
+                        self.bar.refresh()
+        except Exception as e:
+            self.listing_error = e
+        if duplicates:
+            tqdm.write(f'Found {duplicates} files with the same content as others, '
+                       f'they will be uploaded once.')
+
+    def start_listing(self):
+        """List the bucket in a thread while the listed files are uploaded."""
+        self.listing = threading.Thread(target=self.list_bucket, name='migro-listing', daemon=True)
+        self.listing.start()
+
+    def stop_listing(self):
+        """Stop listing the bucket, the listing resumes with the next upload."""
+        if self.listing is not None:
+            self.listing_stopped.set()
+            self.listing.join()
+
+    def start_upload(self, listing=False):
+        """Start the file uploading.
+
+        :param listing: Whether to list the bucket while uploading.
+        """
         click.echo('Starting upload...')
-        files_list = self.db_manager.get_pending_files(self.source)
-        if self.source == self.SOURCES['S3']:
-            self.s3_signed_urls = {value: key for key, value in self.s3_client.create_signed_urls(files_list).items()}
-            files_list = list(self.s3_signed_urls.keys())
-        files_count = len(files_list)
-        self.attempt: int = self.db_manager.start_attempt(self.source, files_count)
-        self.db_manager.set_attempt_for_files(self.attempt)
+        # Files left by runs with other filters are uploaded by the runs they pass.
+        options = {}
+        if self.s3_client is not None and self.s3_client.filter:
+            object_filter = self.s3_client.filter
+            options = {'prefix': object_filter.prefix, 'min_size': object_filter.min_size,
+                       'max_size': object_filter.max_size, 'file_filter': object_filter.key_filter}
+        self.attempt: int = self.db_manager.start_attempt(self.source, 0)
+        files_count = self.db_manager.set_attempt_for_files(self.attempt, **options)
         self.bar = tqdm(desc='Upload progress',
                         total=files_count,
                         miniters=1,
@@ -95,39 +242,43 @@ class Fetcher:
                         dynamic_ncols=True,
                         position=1,
                         maxinterval=3)
-        self.launch_loop(files_list)
+        if settings.REPORT_INCREMENTAL:
+            self.report = open_report(self.attempt, self.source)
+            self.db_manager.on_flush = self.write_report
+        if settings.WORKERS > 1:
+            self.launch_workers(settings.WORKERS)
+        else:
+            if listing:
+                self.start_listing()
+            self.launch_loop(self.iter_upload_files(self.iter_pending()))
 
     def connect_db(self):
         """Connect to the database."""
-        self.db_manager = DBManager()
+        self.db_manager = DBManager(verbose=self.worker is None, worker=self.worker)
+        self.db = AsyncDBManager(self.db_manager)
 
     def disconnect_db(self):
         """Disconnect from the database."""
+        self.db.close()
         self.db_manager.close_connection()
 
-    def update_bar(self, _):
-        """Update the progress bar."""
-        self.bar.update()
+    def update_bar(self, events):
+        """Update the progress bar with a batch of finished files."""
+        if settings.AUTO_CONCURRENCY:
+            self.bar.set_postfix(concurrency=self.uploader.concurrency.limit, refresh=False)
+        self.bar.update(len(events))
 
-    def insert_file(self, path: str, size=None) -> None:
-        """Insert a file into the database."""
-        self.db_manager.insert_file(path, self.source, size)
+    def insert_files(self, files) -> None:
+        """Insert files from an iterable of paths, sizes and ETags into the database."""
+        self.db_manager.insert_files(files, self.source)
 
     def append_successful(self, event):
         """Mark the file as successfully uploaded."""
-        if self.source == self.SOURCES['S3']:
-            file_path = self.s3_signed_urls[event['file'].url]
-        else:
-            file_path = event['file'].url
-        self.db_manager.set_file_uploaded(file_path, self.source, self.attempt, event['file'].uuid)
+        self.db.set_file_uploaded(event.file.id, self.attempt, event.file.uuid, event.file.retries)
 
     def append_failed(self, event):
         """Mark the file as failed to upload."""
-        if self.source == self.SOURCES['S3']:
-            file_path = self.s3_signed_urls[event['file'].url]
-        else:
-            file_path = event['file'].url
-        self.db_manager.set_file_error(file_path, self.source, event['file'].error)
+        self.db.set_file_error(event.file.id, event.file.error, event.file.retries)
 
     @staticmethod
     def show_final_messages(filename, success_count, failed_count):
@@ -141,37 +292,87 @@ class Fetcher:
 
     @staticmethod
     def remove_db():
-        """Removes the database."""
+        """Removes the database with its journals."""
         db_file = get_db_file()
-        if get_db_file().exists():
-            db_file.unlink()
+        for path in db_file.parent.glob(f'{db_file.stem}.*'):
+            path.unlink()
 
     @db
     def upload_urls(self, input_file):
         """Upload files from a file with URLs."""
         self.source: str = self.SOURCES['URLS']
         with open(input_file, 'r') as f:
-            for line in f:
-                self.insert_file(build_url(line.strip()))
+            self.insert_files((build_url(line.strip()), None, None) for line in f)
         self.start_upload()
 
     @db
-    def upload_s3(self):
-        """Upload files from an S3 bucket."""
+    def upload_claimed(self, number, source, attempt, bar):
+        """Upload files of the attempt claimed by worker process `number`."""
+        self.source = source
+        self.attempt = attempt
+        self.bar = bar
+        if settings.REPORT_INCREMENTAL:
+            # The main process writes the report.
+            self.db_manager.on_flush = bar.write_report
+        if self.source == self.SOURCES['S3']:
+            self.s3_client = S3Client()
+            self.uploader.sign = self.s3_client.create_signed_url
+
+        flushing = asyncio.ensure_future(self.db.flush_periodically(), loop=loop)
+        try:
+            rows = self.db.iterate(self.iter_claimed_files(number), settings.WORKER_BATCH_SIZE)
+            loop.run_until_complete(self.uploader.process(self.iter_upload_files(rows)))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        finally:
+            flushing.cancel()
+            self.uploader.shutdown()
+            loop.run_until_complete(self.client.close())
+
+        loop.close()
+
+    @db
+    def upload_s3(self, inventory=None):
+        """Upload files from an S3 bucket.
+
+        :param inventory: `Inventory` report of the bucket to take the files
+            from instead of listing the bucket.
+        """
         self.source: str = self.SOURCES['S3']
         self.s3_client = S3Client()
+        self.uploader.sign = self.s3_client.create_signed_url
         click.echo('Checking the credentials...')
         try:
             self.s3_client.check_credentials()
         except (AccessDeniedError, UnexpectedError) as e:
             click.secho(e, fg='red')
-            asyncio.ensure_future(session.close())
+            loop.run_until_complete(self.client.close())
             return
 
         click.echo('Credentials are correct.')
-        click.echo('Collecting files...')
 
-        for key, size in self.s3_client.get_bucket_contents():
-            self.insert_file(key, size)
-
-        self.start_upload()
+        if inventory is not None:
+            if inventory.source_bucket != self.s3_client.bucket_name:
+                click.secho(f'The inventory report is of "{inventory.source_bucket}" bucket.', fg='red')
+                loop.run_until_complete(self.client.close())
+                return
+            click.echo('Reading the inventory report...')
+            try:
+                self.insert_files(inventory.get_objects(self.s3_client.filter))
+            except (InventoryError, OSError, ValueError, csv.Error) as e:
+                click.secho(f'Failed to read the inventory report: {e}', fg='red')
+                loop.run_until_complete(self.client.close())
+                return
+            duplicates = self.db_manager.mark_duplicates(self.source)
+            if duplicates:
+                click.echo(f'Found {duplicates} files with the same content as others, '
+                           f'they will be uploaded once.')
+            self.start_upload()
+        elif settings.WORKERS > 1:
+            # Worker processes stop once there's nothing to claim,
+            # so the whole bucket is listed first.
+            click.echo('Collecting files...')
+            self.list_bucket()
+            self.start_upload()
+        else:
+            self.start_upload(listing=True)
@@ -0,0 +1,143 @@
+"""
+
+    migro.uploader.filters
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Filters of S3 objects to upload.
+
+"""
+import zlib
+from datetime import timezone
+from fnmatch import fnmatchcase
+
+from migro import settings
+
+
+def get_shard(key, count):
+    """Get the shard of `key` out of `count`, the same in every process
+    and on every machine, unlike `hash`.
+    """
+    return zlib.crc32(key.encode('utf-8')) % count
+
+
+class ObjectFilter:
+    """Filter of S3 objects by key, size, modification time and shard.
+
+    Objects without size or modification time, e.g. from inventory
+    reports without these fields, aren't filtered by them.
+
+    :param prefix: Prefix of the keys.
+    :param include: Patterns the keys must match any of.
+    :param exclude: Patterns the keys must not match.
+    :param min_size: Minimum size, bytes.
+    :param max_size: Maximum size, bytes.
+    :param modified_since: Minimum modification time, naive times are UTC.
+    :param shard: Shard of the keys, index and count.
+
+    """
+    def __init__(self, prefix='', include=None, exclude=None, min_size=None, max_size=None,
+                 modified_since=None, shard=None):
+        self.prefix = prefix or ''
+        self.include = list(include or ())
+        self.exclude = list(exclude or ())
+        self.min_size = min_size
+        self.max_size = max_size
+        if modified_since is not None and modified_since.tzinfo is None:
+            modified_since = modified_since.replace(tzinfo=timezone.utc)
+        self.modified_since = modified_since
+        self.shard = shard
+
+    @classmethod
+    def from_settings(cls):
+        """Create the filter configured with settings."""
+        return cls(prefix=settings.S3_PREFIX,
+                   include=settings.S3_INCLUDE,
+                   exclude=settings.S3_EXCLUDE,
+                   min_size=settings.S3_MIN_SIZE,
+                   max_size=settings.S3_MAX_SIZE,
+                   modified_since=settings.S3_MODIFIED_SINCE,
+                   shard=settings.S3_SHARD)
+
+    def __call__(self, key, size=None, modified=None):
+        """Check whether the object is to be uploaded.
+
+        :param key: Object key.
+        :param size: Object size.
+        :param modified: Object modification time.
+
+        :return: bool.
+
+        """
+        if not key.startswith(self.prefix):
+            return False
+        if not self.match_key(key):
+            return False
+        if size is not None:
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+        if self.modified_since is not None and modified is not None:
+            if modified.tzinfo is None:
+                modified = modified.replace(tzinfo=timezone.utc)
+            if modified < self.modified_since:
+                return False
+        return True
+
+    def __bool__(self):
+        """Whether the filter has any conditions."""
+        return bool(self.prefix or self.conditions)
+
+    def match_key(self, key):
+        """Check the key against the patterns and the shard, not the prefix.
+
+        :param key: Object key.
+
+        :return: bool.
+
+        """
+        if self.include and not any(fnmatchcase(key, pattern) for pattern in self.include):
+            return False
+        if any(fnmatchcase(key, pattern) for pattern in self.exclude):
+            return False
+        if self.shard is not None:
+            index, count = self.shard
+            if get_shard(key, count) != index:
+                return False
+        return True
+
+    @property
+    def key_filter(self):
+        """`match_key` if there are patterns or a shard, None otherwise."""
+        if self.include or self.exclude or self.shard is not None:
+            return self.match_key
+        return None
+
+    @property
+    def conditions(self):
+        """Conditions other than the prefix, e.g. `include=*.jpg shard=1/2`, empty if there are none."""
+        conditions = [f'include={pattern}' for pattern in self.include]
+        conditions += [f'exclude={pattern}' for pattern in self.exclude]
+        if self.min_size is not None:
+            conditions.append(f'min_size={self.min_size}')
+        if self.max_size is not None:
+            conditions.append(f'max_size={self.max_size}')
+        if self.modified_since is not None:
+            conditions.append(f'modified_since={self.modified_since.isoformat()}')
+        if self.shard is not None:
+            index, count = self.shard
+            conditions.append(f'shard={index + 1}/{count}')
+        return ' '.join(conditions)
+
+    def skips_prefix(self, prefix):
+        """Check whether all the keys under `prefix` are excluded, so it's not listed.
+
+        A key prefix matching a pattern ending with `*` means the keys
+        starting with it match the pattern too.
+
+        :param prefix: Key prefix.
+
+        :return: bool.
+
+        """
+        return any(pattern.endswith('*') and fnmatchcase(prefix, pattern) for pattern in self.exclude)
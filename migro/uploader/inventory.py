@@ -0,0 +1,133 @@
+"""
+
+    migro.uploader.inventory
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    S3 Inventory reports reading.
+
+"""
+import csv
+import gzip
+import json
+from pathlib import Path
+from typing import Callable, Generator, Optional, Tuple
+from urllib.parse import unquote_plus
+
+from dateutil.parser import isoparse
+
+# Columns of ORC and Parquet reports, CSV reports list theirs in the manifest.
+COLUMNS = {
+    'Key': 'key',
+    'Size': 'size',
+    'ETag': 'e_tag',
+    'IsLatest': 'is_latest',
+    'IsDeleteMarker': 'is_delete_marker',
+    'LastModifiedDate': 'last_modified_date',
+}
+
+
+class InventoryError(Exception):
+    """S3 Inventory report can't be read."""
+    pass
+
+
+class Inventory:
+    """S3 Inventory report, read from a local copy of its `manifest.json`
+    and data files.
+
+    Data files are looked up next to the manifest, in the `data` folder of
+    the inventory configuration, where S3 puts them, or by their keys
+    relative to the manifest folder.
+
+    :param manifest: Path to `manifest.json`.
+
+    """
+    FORMATS = ('CSV', 'ORC', 'Parquet')
+
+    def __init__(self, manifest):
+        self.manifest = Path(manifest)
+        try:
+            with open(self.manifest, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.source_bucket = data['sourceBucket']
+            self.file_format = data['fileFormat']
+            self.files = [file['key'] for file in data['files']]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise InventoryError(f'Invalid inventory manifest {self.manifest}: {e!r}')
+        if self.file_format not in self.FORMATS:
+            raise InventoryError(f'Unsupported inventory format: {self.file_format}')
+        self.schema = [name.strip() for name in data.get('fileSchema', '').split(',')]
+        if self.file_format == 'CSV' and 'Key' not in self.schema:
+            raise InventoryError('Inventory file schema has no Key column.')
+
+    def get_data_file(self, key: str) -> Path:
+        """Get the local path of data file `key`."""
+        folder = self.manifest.parent
+        name = key.rsplit('/', 1)[-1]
+        for path in (folder.parent / 'data' / name, folder / 'data' / name, folder / name, folder / key):
+            if path.is_file():
+                return path
+        raise InventoryError(f'Inventory data file {name} is not found next to the manifest.')
+
+    def get_objects(self, object_filter: Optional[Callable] = None
+                    ) -> Generator[Tuple[str, Optional[int], Optional[str]], None, None]:
+        """Get the keys, sizes and ETags of the current objects in the report,
+        passing `object_filter` of key, size and modification time.
+
+        Data files are streamed one by one, delete markers
+        and noncurrent versions are skipped.
+        """
+        paths = [self.get_data_file(key) for key in self.files]
+        read = self.read_csv if self.file_format == 'CSV' else self.read_columnar
+        for path in paths:
+            for key, size, etag, is_latest, is_delete_marker, modified in read(path):
+                if is_latest is False or is_delete_marker is True:
+                    continue
+                if object_filter is not None and not object_filter(key, size, modified):
+                    continue
+                yield key, size, etag.strip('"') if etag else None
+
+    def read_csv(self, path: Path) -> Generator[Tuple, None, None]:
+        """Read rows of a gzipped CSV data file, keys in CSV reports are URL-encoded."""
+        indexes = [self.schema.index(column) if column in self.schema else None for column in COLUMNS]
+
+        def get(row, index):
+            return row[index] if index is not None and row[index] != '' else None
+
+        with gzip.open(path, 'rt', newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                key, size, etag, is_latest, is_delete_marker, modified = (get(row, index) for index in indexes)
+                yield (unquote_plus(key),
+                       int(size) if size is not None else None,
+                       etag,
+                       is_latest == 'true' if is_latest is not None else None,
+                       is_delete_marker == 'true' if is_delete_marker is not None else None,
+                       isoparse(modified) if modified is not None else None)
+
+    def read_columnar(self, path: Path) -> Generator[Tuple, None, None]:
+        """Read rows of an ORC or Parquet data file in batches, requires `pyarrow`."""
+        try:
+            if self.file_format == 'ORC':
+                from pyarrow import orc
+            else:
+                from pyarrow import parquet
+        except ImportError:
+            raise InventoryError(f'{self.file_format} inventory reports require pyarrow, '
+                                 f'install it with `pip install uploadcare-migro[inventory]`.')
+
+        if self.file_format == 'ORC':
+            data = orc.ORCFile(path)
+            names = data.schema.names
+            columns = [column for column in COLUMNS.values() if column in names]
+            batches = (data.read_stripe(stripe, columns=columns) for stripe in range(data.nstripes))
+        else:
+            data = parquet.ParquetFile(path)
+            names = data.schema_arrow.names
+            columns = [column for column in COLUMNS.values() if column in names]
+            batches = data.iter_batches(columns=columns)
+        if COLUMNS['Key'] not in columns:
+            raise InventoryError(f'Inventory data file {path.name} has no key column.')
+        for batch in batches:
+            values = batch.to_pydict()
+            rows = len(values[COLUMNS['Key']])
+            yield from zip(*(values.get(column, [None] * rows) for column in COLUMNS.values()))
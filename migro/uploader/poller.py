@@ -0,0 +1,266 @@
+"""
+
+    migro.uploader.poller
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Coalesced `from_url` status poller.
+
+"""
+import asyncio
+import heapq
+import itertools
+import sys
+
+from migro import settings
+from migro.uploader.retry import TRANSIENT_ERRORS, is_transient_status
+
+
+class Token:
+    """An outstanding `from_url` token tracked by the poller.
+
+    :param file: `File` instance the token belongs to.
+    :param future: Future resolved with the polling outcome.
+    :param started: Loop time the token was registered at.
+    :param interval: Current delay between two status checks, seconds.
+    :param last_done: Amount of bytes downloaded at the last progress check.
+    :param last_checked: Loop time of the last progress check.
+
+    """
+    __slots__ = ('file', 'future', 'started', 'interval', 'last_done', 'last_checked')
+
+    def __init__(self, file, future, started, interval):
+        self.file = file
+        self.future = future
+        self.started = started
+        self.interval = interval
+        self.last_done = None
+        self.last_checked = None
+
+
+class StatusPoller:
+    """A single poller owning all outstanding `from_url` tokens.
+
+    Instead of running a polling loop per file, every token is registered
+    in one schedule and checked when it is due:
+
+    * while the status is ``waiting`` the interval is backed off
+      exponentially;
+    * a ``progress`` status estimates the remaining download time from
+      ``done``/``total`` and schedules the next check for then;
+    * all the status requests share a global requests-per-second cap,
+      which grows with the number of outstanding tokens, and a limit
+      of requests running at once;
+    * failed status requests (network errors, 5xx) are repeated later,
+      till the token times out.
+
+    :param client: Upload API client.
+    :param loop: Poller event loop.
+    :param min_interval: Minimal delay between two checks of a token, seconds.
+    :param max_interval: Maximal delay between two checks of a token, seconds.
+    :param backoff: Interval multiplier applied while there is no progress.
+    :param rate: Maximum number of status requests per second, unless more
+        are needed to check every token once per `max_interval`.
+    :param concurrency: Maximum number of status requests running at once.
+    :param timeout: Seconds to wait till a token is processed by Uploadcare.
+
+    """
+    SUCCESS = 'success'
+    ERROR = 'error'
+    TIMEOUT = 'timeout'
+
+    def __init__(self, client, loop=None, min_interval=None, max_interval=None,
+                 backoff=None, rate=None, concurrency=None, timeout=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.client = client
+        self.loop_kwargs = {'loop': self.loop} if sys.version_info < (3, 10) else {}
+
+        self.min_interval = min_interval or settings.STATUS_CHECK_INTERVAL
+        self.max_interval = max(max_interval or settings.STATUS_CHECK_MAX_INTERVAL,
+                                self.min_interval)
+        self.backoff = backoff or settings.STATUS_CHECK_BACKOFF
+        self.rate = rate or settings.STATUS_CHECK_RATE
+        self.concurrency = concurrency or settings.STATUS_CHECK_CONNECTIONS
+        self.timeout = timeout or settings.FROM_URL_TIMEOUT
+
+        self._schedule = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event(**self.loop_kwargs)
+        self._stopping = False
+        self._next_request = 0.0
+        self._checks = set()
+        self._semaphore = asyncio.Semaphore(self.concurrency, **self.loop_kwargs)
+
+    def __len__(self):
+        return len(self._schedule) + len(self._checks)
+
+    def track(self, file):
+        """Register `file` upload token for status checks.
+
+        :param file: `File` instance with an upload token.
+
+        :return: Future resolved with one of `SUCCESS`, `ERROR` or `TIMEOUT`.
+
+        """
+        now = self.loop.time()
+        token = Token(file, self.loop.create_future(), now, self.min_interval)
+        self._push(token, now + self.min_interval)
+        return token.future
+
+    async def wait(self, file):
+        """Wait till `file` will be processed by Uploadcare or
+        `timeout` seconds before timeout.
+
+        :param file: `File` instance with an upload token.
+
+        :return: One of `SUCCESS`, `ERROR` or `TIMEOUT`.
+
+        """
+        return await self.track(file)
+
+    async def run(self):
+        """Poller coroutine, dispatches due status checks till `stop` is called."""
+        while not self._stopping:
+            if not self._schedule:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self._schedule[0][0] - self.loop.time()
+            if delay > 0:
+                # A timer instead of `wait_for`, which may swallow cancellation
+                # when the wait finishes at the same time.
+                self._wakeup.clear()
+                timer = self.loop.call_later(delay, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    timer.cancel()
+                continue
+
+            _, _, token = heapq.heappop(self._schedule)
+            if token.future.done():
+                # Nobody waits for this token anymore.
+                continue
+            await self._semaphore.acquire()
+            await self._throttle()
+            check = asyncio.ensure_future(self._check(token), loop=self.loop)
+            self._checks.add(check)
+            check.add_done_callback(self._check_done)
+        return None
+
+    def stop(self):
+        """Cancel all the running checks and outstanding tokens, make `run` exit."""
+        self._stopping = True
+        self._wakeup.set()
+        for check in self._checks:
+            check.cancel()
+        for _, _, token in self._schedule:
+            token.future.cancel()
+        self._schedule = []
+        return None
+
+    def _check_done(self, check):
+        self._checks.discard(check)
+        self._semaphore.release()
+
+    def _push(self, token, due):
+        heapq.heappush(self._schedule, (due, next(self._counter), token))
+        if self._schedule[0][2] is token:
+            # The new check is the earliest one, wake the poller up.
+            self._wakeup.set()
+
+    async def _throttle(self):
+        """Keep status requests under `rate` requests per second, raised
+        to check every outstanding token at least once per `max_interval`.
+        """
+        now = self.loop.time()
+        delay = self._next_request - now
+        if delay > 0:
+            await asyncio.sleep(delay, **self.loop_kwargs)
+        rate = max(self.rate, len(self) / self.max_interval)
+        self._next_request = max(now, self._next_request) + 1.0 / rate
+
+    async def _check(self, token):
+        """Make a single status request for `token`."""
+        try:
+            await self._request_status(token)
+        except asyncio.CancelledError:
+            raise
+        except TRANSIENT_ERRORS as e:
+            self._reschedule(token, 'Request error: {0!r}'.format(e))
+        except Exception as e:
+            # Let the waiting coroutine handle the failure.
+            if not token.future.done():
+                token.future.set_exception(e)
+        return None
+
+    async def _request_status(self, token):
+        file = token.file
+        response = await self.client.from_url_status(file.upload_token)
+        if response.status == 429:
+            # The requests are paused by the rate limiter, check again later.
+            now = self.loop.time()
+            deadline = token.started + self.timeout
+            if now >= deadline:
+                file.error = 'Status check timeout.'
+                return self._resolve(token, self.TIMEOUT)
+            self._push(token, min(now + token.interval, deadline))
+            return None
+        elif is_transient_status(response.status):
+            return self._reschedule(token, 'Request error: {0}'.format(response.status))
+        elif response.status != 200:
+            file.error = 'Request error: {0}'.format(response.status)
+            return self._resolve(token, self.ERROR)
+
+        result = await response.json()
+        if result['status'] == 'error':
+            file.error = result.get('error', 'unknown')
+            return self._resolve(token, self.ERROR)
+        elif result['status'] == 'success':
+            file.data = result
+            file.uuid = result['uuid']
+            return self._resolve(token, self.SUCCESS)
+
+        return self._reschedule(token, 'Status check timeout.', result)
+
+    def _reschedule(self, token, timeout_error, result=None):
+        """Schedule the next check of `token` or time it out."""
+        now = self.loop.time()
+        deadline = token.started + self.timeout
+        if now >= deadline:
+            token.file.error = timeout_error
+            return self._resolve(token, self.TIMEOUT)
+
+        token.interval = self._next_interval(token, result or {}, now)
+        self._push(token, min(now + token.interval, deadline))
+        return None
+
+    def _next_interval(self, token, result, now):
+        """Calculate delay before the next check of `token`.
+
+        While Uploadcare reports download progress, the next check is
+        scheduled for the moment the download is expected to finish.
+        Otherwise the current interval is backed off.
+
+        """
+        done, total = result.get('done'), result.get('total')
+        interval = token.interval * self.backoff
+
+        if isinstance(done, (int, float)) and isinstance(total, (int, float)) \
+                and 0 < done < total:
+            if token.last_done is not None and done > token.last_done:
+                speed = (done - token.last_done) / max(now - token.last_checked, 1e-3)
+            else:
+                speed = done / max(now - token.started, 1e-3)
+            interval = (total - done) / speed
+            token.last_done, token.last_checked = done, now
+
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    @staticmethod
+    def _resolve(token, outcome):
+        if not token.future.done():
+            token.future.set_result(outcome)
+        return None
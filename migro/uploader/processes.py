@@ -0,0 +1,190 @@
+"""
+
+    migro.uploader.processes
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Uploading in several worker processes.
+
+"""
+import multiprocessing
+import time
+from queue import Empty
+
+from migro import settings
+
+# Settings shared by all the worker processes, split between them,
+# so the workers together keep within the configured limits and
+# don't read ahead more files than the others. The status check rate
+# grows with the files waiting for their status, so it isn't split.
+SHARED_LIMITS = ('MAX_CONCURRENT_UPLOADS', 'REQUESTS_PER_SECOND', 'STAGE_QUEUE_SIZE')
+
+
+def worker_settings(workers, number=0):
+    """Get settings of a worker process.
+
+    Integer limits are split so that the parts add up to the limit,
+    the first workers get the remainder. Every worker gets at least 1.
+
+    :param workers: Number of worker processes.
+    :param number: Worker number.
+
+    :return: dict.
+
+    """
+    options = {name: getattr(settings, name) for name in dir(settings) if name.isupper()}
+    for name in SHARED_LIMITS:
+        if options[name]:
+            if isinstance(options[name], int):
+                part, remainder = divmod(options[name], workers)
+                options[name] = max(part + (number < remainder), 1)
+            else:
+                options[name] = options[name] / workers
+    options['WORKERS'] = 1
+    return options
+
+
+class ProgressQueue:
+    """Progress bar stand-in of a worker process, passes the number of
+    finished files, their report rows and the postfix values, e.g. the
+    concurrency limit, to the main process.
+
+    :param queue: `multiprocessing.Queue` read by the main process.
+    :param number: Worker number.
+
+    """
+    def __init__(self, queue, number=0):
+        self.queue = queue
+        self.number = number
+        self.postfix = {}
+
+    def update(self, count):
+        self.queue.put(count)
+
+    def write_report(self, rows):
+        self.queue.put(list(rows))
+
+    def set_postfix(self, refresh=True, **kwargs):
+        if kwargs != self.postfix:
+            self.postfix = kwargs
+            self.queue.put((self.number, kwargs))
+        return None
+
+    def close(self):
+        return None
+
+
+def run_worker(number, source, attempt, options, progress, paused_until):
+    """Worker process entry point: upload files claimed from `attempt`.
+
+    :param number: Worker number.
+    :param source: Files source.
+    :param attempt: Attempt ID.
+    :param options: Settings of the process.
+    :param progress: Queue of the finished files counts, report rows and postfixes.
+    :param paused_until: Shared time the upload API requests are paused till.
+
+    """
+    for name, value in options.items():
+        setattr(settings, name, value)
+
+    from migro.uploader.fetcher import Fetcher
+    fetcher = Fetcher(worker=number)
+    fetcher.client.rate_limiter.shared = paused_until
+    fetcher.upload_claimed(number, source, attempt, ProgressQueue(progress, number))
+    return None
+
+
+class WorkerPool:
+    """Worker processes uploading files of an attempt.
+
+    Processes are spawned, not forked, so every one of them starts with
+    its own event loop and connections. They claim disjoint batches of
+    files from the database and write the results there, the main process
+    only shows the overall progress and writes the incremental report.
+    A throttled response pauses the upload API requests of all the workers.
+
+    :param workers: Number of worker processes.
+    :param source: Files source.
+    :param attempt: Attempt ID.
+    :param report: Function writing report rows of the files finished
+        by the workers, if the report is incremental.
+
+    """
+    def __init__(self, workers, source, attempt, report=None):
+        self.workers = workers
+        self.source = source
+        self.attempt = attempt
+        self.report = report
+        self.context = multiprocessing.get_context('spawn')
+        self.progress = self.context.Queue()
+        self.paused_until = self.context.Value('d', 0.0)
+        self.postfixes = {}
+        self.processes = []
+
+    def start(self):
+        """Start the worker processes."""
+        for number in range(self.workers):
+            process = self.context.Process(
+                target=run_worker,
+                args=(number, self.source, self.attempt, worker_settings(self.workers, number),
+                      self.progress, self.paused_until),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+        return None
+
+    def wait(self, bar):
+        """Update `bar` with the workers progress till all of them exit.
+
+        :param bar: Progress bar.
+
+        """
+        while any(process.is_alive() for process in self.processes):
+            self._update(bar, timeout=0.5)
+        self._update(bar)
+        for process in self.processes:
+            process.join()
+        return None
+
+    def stop(self, bar, timeout=10):
+        """Give the worker processes `timeout` seconds to finish, e.g. after
+        they got interrupted, then terminate them.
+
+        :param bar: Progress bar.
+        :param timeout: Seconds to wait for every process.
+
+        """
+        for process in self.processes:
+            deadline = time.monotonic() + timeout
+            # Keep reading the queue, a process doesn't exit till its items are read.
+            while process.is_alive() and time.monotonic() < deadline:
+                self._update(bar, timeout=0.1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._update(bar)
+        return None
+
+    def _update(self, bar, timeout=None):
+        try:
+            item = self.progress.get(timeout=timeout) if timeout else self.progress.get_nowait()
+            while True:
+                if isinstance(item, list):
+                    if self.report:
+                        self.report(item)
+                elif isinstance(item, tuple):
+                    self._set_postfix(bar, *item)
+                else:
+                    bar.update(item)
+                item = self.progress.get_nowait()
+        except Empty:
+            pass
+
+    def _set_postfix(self, bar, number, postfix):
+        """Show the postfix values of all the workers, e.g. `concurrency=4/5/5`."""
+        self.postfixes[number] = postfix
+        names = {name: None for values in self.postfixes.values() for name in values}
+        bar.set_postfix(refresh=False, **{
+            name: '/'.join(str(self.postfixes[worker].get(name, '-')) for worker in sorted(self.postfixes))
+            for name in names
+        })
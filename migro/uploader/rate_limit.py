@@ -0,0 +1,90 @@
+"""
+
+    migro.uploader.rate_limit
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Upload API rate limiter.
+
+"""
+import asyncio
+import time
+
+
+class RateLimiter:
+    """Token bucket shared by all the upload API requests.
+
+    Every request takes a token, tokens are refilled at `rate` per second
+    up to `capacity`. A throttled response pauses all the requests at once
+    till its `Retry-After` passes, after that the bucket starts empty,
+    so the requests are resumed at `rate` instead of all together.
+
+    :param rate: Number of requests per second, unlimited if omitted.
+    :param capacity: Maximum burst size, `rate` if omitted.
+    :param clock: Monotonic time source.
+    :param shared: `multiprocessing.Value` of the time the requests of all
+        the processes are paused till, seconds since the epoch. A pause made
+        by any of the processes pauses the others too.
+
+    """
+    def __init__(self, rate=None, capacity=None, clock=time.monotonic, shared=None):
+        self.rate = rate
+        self.capacity = max(capacity or rate or 1, 1)
+        self.clock = clock
+        self.shared = shared
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    @property
+    def paused(self):
+        """Whether the requests are paused now."""
+        return self._paused_until > self.clock()
+
+    async def acquire(self):
+        """Wait till a request can be made."""
+        while True:
+            if self.shared is not None:
+                self._follow_shared()
+            now = self.clock()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if not self.rate:
+                return None
+
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return None
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Pause all the requests for `seconds`.
+
+        :param seconds: Pause duration, e.g. `Retry-After` header value.
+
+        """
+        self._pause(seconds)
+        if self.shared is not None:
+            with self.shared.get_lock():
+                self.shared.value = max(self.shared.value, time.time() + seconds)
+        return None
+
+    def _pause(self, seconds):
+        until = self.clock() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0
+            self._updated = until
+
+    def _follow_shared(self):
+        """Pause the requests if another process paused them."""
+        seconds = self.shared.value - time.time()
+        if seconds > 0:
+            self._pause(seconds)
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self._tokens + (now - self._updated) * self.rate,
+                               self.capacity)
+            self._updated = now
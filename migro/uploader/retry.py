@@ -0,0 +1,62 @@
+"""
+
+    migro.uploader.retry
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Retry policy for transient failures.
+
+"""
+import asyncio
+import random
+
+from aiohttp import ClientError
+
+from migro import settings
+
+# Exceptions worth retrying: connection resets, DNS failures, timeouts.
+TRANSIENT_ERRORS = (ClientError, asyncio.TimeoutError)
+
+
+def is_transient_status(status):
+    """Whether response `status` code is worth retrying.
+
+    :param status: HTTP status code.
+
+    :return: bool.
+
+    """
+    return status >= 500 or status == 408
+
+
+class RetryPolicy:
+    """Per-file retries with exponential backoff and full jitter.
+
+    :param max_retries: Maximum number of retries of a file.
+    :param backoff: Base delay before the first retry, seconds.
+    :param max_backoff: Maximum delay before a retry, seconds.
+
+    """
+    def __init__(self, max_retries=None, backoff=None, max_backoff=None):
+        self.max_retries = settings.MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = settings.RETRY_BACKOFF if backoff is None else backoff
+        self.max_backoff = settings.RETRY_MAX_BACKOFF if max_backoff is None else max_backoff
+
+    def should_retry(self, file):
+        """Whether `file` has retries left.
+
+        :param file: `File` instance.
+
+        :return: bool.
+
+        """
+        return file.retries < self.max_retries
+
+    def delay(self, retry):
+        """Get delay before `retry`-th retry, seconds.
+
+        :param retry: Retry number, starting from 1.
+
+        :return: float.
+
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
@@ -1,9 +1,27 @@
-from typing import Dict, Generator, List, Tuple
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Generator, Iterable, List, NamedTuple, Optional, Tuple
 
 import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
 
 from migro import settings
+from migro.uploader.filters import ObjectFilter
+from migro.uploader.s3_signer import S3Signer
+
+# The greatest character, keys under a prefix come before the prefix followed by it.
+LAST_CHARACTER = '\U0010ffff'
+
+
+class ListingPage(NamedTuple):
+    """Listing page of a prefix: keys, sizes and ETags, prefixes found with their levels,
+    the last key listed and whether the prefix is listed till the end."""
+    prefix: str
+    objects: List[Tuple[str, int, Optional[str]]]
+    prefixes: List[Tuple[str, int]]
+    last_key: Optional[str]
+    last: bool
 
 
 class S3ClientException(Exception):
@@ -28,26 +46,30 @@ class S3Client:
                 and settings.S3_SECRET_ACCESS_KEY \
                 and settings.S3_REGION \
                 and settings.S3_BUCKET_NAME:
-            self.s3 = boto3.client(
-                's3',
+            session = boto3.Session(
                 aws_access_key_id=settings.S3_ACCESS_KEY_ID,
                 aws_secret_access_key=settings.S3_SECRET_ACCESS_KEY,
                 region_name=settings.S3_REGION,
             )
         else:
-            try:
-                self.s3 = boto3.client(
-                    's3'
-                )
-            except NoCredentialsError:
-                raise AccessDeniedError("No AWS credentials found.")
+            session = boto3.Session()
+        try:
+            self.s3 = session.client('s3')
+        except NoCredentialsError:
+            raise AccessDeniedError("No AWS credentials found.")
+        self.filter = ObjectFilter.from_settings()
+        self.signer = None
+        credentials = session.get_credentials()
+        if credentials is not None:
+            self.signer = S3Signer(credentials, self.s3.meta.region_name, self.bucket_name,
+                                   self.s3.meta.endpoint_url, settings.S3_URL_EXPIRATION_TIME)
 
     def check_credentials(self) -> None:
         """Check if the credentials are valid and have access to list and get objects."""
         paginator = self.s3.get_paginator('list_objects_v2')
         operation = "ListObjects"
         try:
-            for page in paginator.paginate(Bucket=self.bucket_name):
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.filter.prefix):
                 operation = "GetObject"
                 if 'Contents' in page:
                     for obj in page['Contents']:
@@ -64,27 +86,136 @@ class S3Client:
             else:
                 raise UnexpectedError(str(e))
 
-    def get_bucket_contents(self) -> Generator[Tuple[str, int], None, None]:
-        """Get the contents of the bucket."""
+    @property
+    def listing_name(self) -> str:
+        """Name the listing position is saved under, a listing with other
+        filters lists the bucket again.
+        """
+        name = self.bucket_name
+        if self.filter.prefix:
+            name = f'{name}/{self.filter.prefix}'
+        if self.filter.conditions:
+            name = f'{name} [{self.filter.conditions}]'
+        return name
+
+    def get_partitions(self) -> List[str]:
+        """Get the prefixes the bucket listing starts with."""
+        prefix = self.filter.prefix
+        if settings.S3_PARTITIONS:
+            return [prefix + partition for partition in settings.S3_PARTITIONS]
+        return [prefix]
+
+    def get_bucket_contents(self) -> Generator[Tuple[str, int, str], None, None]:
+        """Get the keys, sizes and ETags of the bucket contents.
+
+        Keys are yielded as soon as their pages arrive, in no particular order.
+        """
+        for page in self.iter_listing([(prefix, 0, None) for prefix in self.get_partitions()]):
+            yield from page.objects
+
+    def iter_pages(self, prefix: str = '', delimiter: str = None,
+                   start_after: str = None) -> Generator[Tuple[List, List, Optional[str]], None, None]:
+        """Iterate over pages of keys under `prefix`, after `start_after` key.
+
+        Every page is the keys, sizes and ETags of the objects passing `filter`,
+        the common prefixes with `delimiter` not skipped by `filter` and the last
+        key or prefix of the page. The listing resumed after a common prefix starts
+        after all of its keys, the prefix found before is listed on its own.
+        """
         paginator = self.s3.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=self.bucket_name)
+        params = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if delimiter:
+            params['Delimiter'] = delimiter
+        if start_after:
+            if delimiter and delimiter in start_after[len(prefix):]:
+                start_after += LAST_CHARACTER
+            params['StartAfter'] = start_after
 
-        for page in pages:
-            for obj in page.get('Contents', []):
-                key = obj['Key']
-                size = obj['Size']
-                yield key, size
+        for page in paginator.paginate(**params):
+            contents = page.get('Contents', [])
+            prefixes = [common['Prefix'] for common in page.get('CommonPrefixes', [])]
+            last_key = max([obj['Key'] for obj in contents[-1:]] + prefixes, default=None)
+            objects = [(obj['Key'], obj['Size'], obj.get('ETag', '').strip('"') or None)
+                       for obj in contents
+                       if self.filter(obj['Key'], obj['Size'], obj.get('LastModified'))]
+            prefixes = [found for found in prefixes if not self.filter.skips_prefix(found)]
+            yield objects, prefixes, last_key
 
-    def create_signed_urls(self, keys: List) -> Dict:
+    def iter_listing(self, tasks: Iterable[Tuple[str, int, Optional[str]]]) -> Generator[ListingPage, None, None]:
+        """Iterate over listing pages of prefixes as they arrive.
+
+        `tasks` are the prefixes to list, their levels and the keys to start after.
+        The prefixes are listed by `settings.S3_LISTING_THREADS` threads. Unless
+        `settings.S3_PARTITIONS` are set, prefixes less than `settings.S3_DISCOVERY_DEPTH`
+        levels deep are listed with "/" delimiter and the prefixes found are listed
+        in their turn. The last page of every prefix is an empty one.
+        """
+        threads = max(settings.S3_LISTING_THREADS, 1)
+        depth = 0 if threads == 1 or settings.S3_PARTITIONS else settings.S3_DISCOVERY_DEPTH
+        pages = queue.Queue(maxsize=threads * 2)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def list_prefix(prefix, level, start_after):
+            try:
+                pages = self.iter_pages(prefix, '/' if level < depth else None, start_after)
+                for objects, found, last_key in pages:
+                    found = [(key, level + 1) for key in found]
+                    if stopped.is_set() or not put(ListingPage(prefix, objects, found, last_key, False)):
+                        return
+                put(ListingPage(prefix, [], [], None, True))
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='migro-s3')
+        try:
+            remaining = 0
+            for task in tasks:
+                executor.submit(list_prefix, *task)
+                remaining += 1
+            while remaining:
+                item = pages.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    for prefix, level in item.prefixes:
+                        executor.submit(list_prefix, prefix, level, None)
+                        remaining += 1
+                    yield item
+        finally:
+            stopped.set()
+            executor.shutdown(wait=False)
+
+    def create_signed_url(self, key: str) -> str:
+        """
+        Create signed URL for a file key.
+        """
+        if self.signer is not None:
+            return self.signer.sign(key)
+        return self.s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket_name, 'Key': key},
+            ExpiresIn=settings.S3_URL_EXPIRATION_TIME
+        )
+
+    def create_signed_urls(self, keys: Iterable[str]) -> Dict:
         """
         Create signed URLs for a list of file keys.
         """
-        signed_urls = {}
-        for key in keys:
-            signed_url: Dict = self.s3.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': self.bucket_name, 'Key': key},
-                ExpiresIn=settings.S3_URL_EXPIRATION_TIME
-            )
-            signed_urls[key] = signed_url
-        return signed_urls
+        keys = list(keys)
+        if self.signer is not None:
+            return dict(zip(keys, self.signer.sign_many(keys)))
+        return {key: self.create_signed_url(key) for key in keys}
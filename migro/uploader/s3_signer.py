@@ -0,0 +1,125 @@
+"""
+
+    migro.uploader.s3_signer
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Presigning of S3 object URLs.
+
+"""
+import hashlib
+import hmac
+import re
+import time
+from urllib.parse import quote, urlsplit
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+# Bucket names usable as a host name label, others are addressed by path.
+DNS_BUCKET_NAME = re.compile(r'^[a-z0-9][a-z0-9-]{1,61}[a-z0-9]$')
+
+
+def encode(value, safe='-_.~'):
+    """Percent-encode `value` the way AWS Signature Version 4 requires."""
+    return quote(value, safe=safe)
+
+
+def hmac_sha256(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+class S3Signer:
+    """Signs `GetObject` URLs with AWS Signature Version 4 query parameters.
+
+    Makes the same URLs as `generate_presigned_url` of a boto3 client with
+    `s3v4` signatures and virtual-hosted addressing, without building and
+    signing a request object per URL. The signing key is derived once a day,
+    the parts of the URLs shared by all the keys once a second.
+
+    :param credentials: botocore credentials, refreshed ones are picked up.
+    :param region: Bucket region.
+    :param bucket: Bucket name.
+    :param endpoint_url: S3 endpoint URL of the region.
+    :param expires: URL expiration time, seconds.
+
+    """
+    def __init__(self, credentials, region, bucket, endpoint_url, expires):
+        self.credentials = credentials
+        self.region = region
+        self.expires = expires
+        endpoint = urlsplit(endpoint_url)
+        if DNS_BUCKET_NAME.match(bucket):
+            self.host = f'{bucket}.{endpoint.netloc}'
+            self.path = '/'
+        else:
+            self.host = endpoint.netloc
+            self.path = f'/{encode(bucket)}/'
+        self.base_url = f'{endpoint.scheme}://{self.host}'
+        self._signing_key = (None, None, None)
+        self._prepared = (None, None)
+
+    def sign(self, key, now=None):
+        """Sign URL of object `key`.
+
+        :param key: Object key.
+        :param now: Signing time, seconds since the epoch, the current time if omitted.
+
+        :return: str.
+
+        """
+        return self.sign_many([key], now)[0]
+
+    def sign_many(self, keys, now=None):
+        """Sign URLs of object `keys` with the same time and credentials.
+
+        :param keys: Object keys.
+        :param now: Signing time, seconds since the epoch, the current time if omitted.
+
+        :return: list of str.
+
+        """
+        signing_key, query, request_tail, string_head = self.prepare(now)
+        urls = []
+        for key in keys:
+            path = self.path + encode(key, safe='/~')
+            canonical_request = f'GET\n{path}{request_tail}'
+            string_to_sign = string_head + hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+            signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+            urls.append(f'{self.base_url}{path}?{query}&X-Amz-Signature={signature}')
+        return urls
+
+    def prepare(self, now=None):
+        """Get the signing key and the parts of URLs, canonical requests and
+        strings to sign that don't depend on the object key.
+        """
+        credentials = self.credentials.get_frozen_credentials()
+        timestamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now))
+        cache_key = (timestamp, credentials)
+        if self._prepared[0] == cache_key:
+            return self._prepared[1]
+
+        date = timestamp[:8]
+        scope = f'{date}/{self.region}/s3/aws4_request'
+        params = [
+            ('X-Amz-Algorithm', ALGORITHM),
+            ('X-Amz-Credential', f'{credentials.access_key}/{scope}'),
+            ('X-Amz-Date', timestamp),
+            ('X-Amz-Expires', str(self.expires)),
+            ('X-Amz-SignedHeaders', 'host'),
+        ]
+        if credentials.token is not None:
+            params.append(('X-Amz-Security-Token', credentials.token))
+        query = '&'.join(f'{name}={encode(value)}' for name, value in params)
+        canonical_query = '&'.join(f'{name}={encode(value)}' for name, value in sorted(params))
+        request_tail = f'\n{canonical_query}\nhost:{self.host}\n\nhost\nUNSIGNED-PAYLOAD'
+        string_head = f'{ALGORITHM}\n{timestamp}\n{scope}\n'
+        prepared = (self.get_signing_key(credentials.secret_key, date), query, request_tail, string_head)
+        self._prepared = (cache_key, prepared)
+        return prepared
+
+    def get_signing_key(self, secret_key, date):
+        """Get the signing key of `date`, derived once per day and secret key."""
+        if self._signing_key[:2] != (secret_key, date):
+            key = hmac_sha256(f'AWS4{secret_key}'.encode('utf-8'), date)
+            for part in (self.region, 's3', 'aws4_request'):
+                key = hmac_sha256(key, part)
+            self._signing_key = (secret_key, date, key)
+        return self._signing_key[2]
@@ -0,0 +1,105 @@
+"""
+
+    migro.uploader.transport
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    HTTP transport for upload API requests.
+
+"""
+import json
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from migro import settings
+
+
+class Response:
+    """Upload API response with the body read and the connection released.
+
+    :param status: HTTP status code.
+    :param headers: Response headers.
+    :param body: Response body.
+
+    """
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    async def json(self):
+        return json.loads(self.body)
+
+    async def text(self):
+        return self.body.decode('utf-8', errors='replace')
+
+
+class Transport:
+    """Connection pool shared by all the upload API requests.
+
+    The pool has a connection for every upload request and every status
+    check allowed to run at once, so none of them waits for a free
+    connection. Connections are kept alive, DNS responses are cached and
+    every response is read and released before it's returned.
+
+    :param limit: Maximum number of connections.
+    :param limit_per_host: Maximum number of connections to the same host.
+    :param keepalive_timeout: Seconds to keep an idle connection open.
+    :param dns_cache_ttl: Seconds to cache resolved host names for.
+    :param timeout: Total request timeout, seconds.
+    :param connect_timeout: Connection timeout, seconds.
+
+    """
+    def __init__(self, limit=None, limit_per_host=None, keepalive_timeout=None,
+                 dns_cache_ttl=None, timeout=None, connect_timeout=None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._session = None
+
+    @property
+    def session(self):
+        """Client session, created on first use inside the running loop
+        when the settings are already configured."""
+        if self._session is None or self._session.closed:
+            limit = self.limit or settings.CONNECTION_POOL_SIZE or (
+                settings.MAX_CONCURRENT_UPLOADS + settings.STATUS_CHECK_CONNECTIONS)
+            connector = TCPConnector(
+                ssl=False,
+                limit=limit,
+                limit_per_host=self.limit_per_host or limit,
+                keepalive_timeout=self.keepalive_timeout or settings.KEEPALIVE_TIMEOUT,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl or settings.DNS_CACHE_TTL,
+            )
+            timeout = ClientTimeout(
+                total=self.timeout or settings.REQUEST_TIMEOUT,
+                connect=self.connect_timeout or settings.CONNECT_TIMEOUT,
+            )
+            self._session = ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def request(self, method, url, **kwargs):
+        """Make HTTP request.
+
+        :param method: HTTP method.
+        :param url: Request URL.
+        :param kwargs: `aiohttp.ClientSession.request` arguments.
+
+        :return: Response.
+
+        """
+        async with self.session.request(method, url, **kwargs) as response:
+            body = await response.read()
+            return Response(response.status, response.headers, body)
+
+    async def close(self):
+        """Close all the connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        return None
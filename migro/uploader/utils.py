@@ -10,52 +10,24 @@ import hashlib
 import hmac
 import time
 from asyncio import get_event_loop
-from urllib.parse import urljoin
 
-from aiohttp import ClientSession, TCPConnector
-
-from migro import __version__ as version
 from migro import settings
 
 loop = get_event_loop()
-session = ClientSession(connector=TCPConnector(verify_ssl=False, loop=loop))
 
 
-async def request(path, params=None):
-    """Makes GET upload API request with specific path and params.
+def get_retry_after(response):
+    """Get number of seconds to wait from throttled `response`.
 
-    :param path: Request path.
-    :param params: Request params.
+    :param response: migro.uploader.transport.Response.
 
-    :return: aiohttp.ClientResponse.
+    :return: float.
 
     """
-    path = path.lstrip('/')
-    url = urljoin(settings.UPLOAD_BASE, path)
-
-    headers = {
-        "User-Agent": f"Migro/{version}/{settings.PUBLIC_KEY}"
-    }
-
-    if params is None:
-        params = {}
-    params['pub_key'] = settings.PUBLIC_KEY
-    params['UPLOADCARE_PUB_KEY'] = settings.PUBLIC_KEY
-
-    if settings.SECRET_KEY:
-        expire_timestamp = generate_expire_timestamp()
-        upload_signature = generate_secure_signature(settings.SECRET_KEY, expire_timestamp)
-
-        params['signature'] = upload_signature
-        params['expire'] = expire_timestamp
-
-    response = await session.request(
-        method='get',
-        url=url,
-        headers=headers,
-        allow_redirects=True,
-        params=params)
-    return response
+    try:
+        return float(response.headers.get('Retry-After', settings.THROTTLING_TIMEOUT))
+    except ValueError:
+        return settings.THROTTLING_TIMEOUT
 
 
 def generate_expire_timestamp(minutes_ahead=5):
@@ -8,46 +8,44 @@
 """
 import asyncio
 import sys
-import time
-from collections import defaultdict
-from enum import Enum
-from uuid import uuid4
 
 from migro import settings
-from migro.uploader.utils import request
+from migro.uploader.client import UploadAPIClient
+from migro.uploader.concurrency import ConcurrencyLimiter
+from migro.uploader.events import EventBus, Events
+from migro.uploader.poller import StatusPoller
+from migro.uploader.retry import (TRANSIENT_ERRORS, RetryPolicy,
+                                  is_transient_status)
 
-
-class Events(Enum):
-    """Available events."""
-    UPLOAD_ERROR = 'UPLOAD_ERROR'
-    UPLOAD_THROTTLED = 'UPLOAD_THROTTLED'
-    UPLOAD_COMPLETE = 'UPLOAD_COMPLETE'
-    # Download on Uploadcare side.
-    DOWNLOAD_ERROR = 'DOWNLOAD_ERROR'
-    DOWNLOAD_COMPLETE = 'DOWNLOAD_COMPLETE'
-
-    def __str__(self):
-        return self.value
+# Seconds to wait for the cancelled tasks on shutdown.
+SHUTDOWN_TIMEOUT = 5
 
 
 class File:
     """An uploading file instance.
+
+    Millions of files may be processed, so the instance is slotted.
     
     :param error: Current file migration error.
     :param uuid: Uploaded to uploadcare file id .
     :param upload_token: `from_url` upload token.
     :param data: Uploaded to uploadcare file data.
-    :param url: `from_url` file url - from where to download it.
-    :param id: local file id.
+    :param url: `from_url` file url - from where to download it,
+        or what the uploader `sign` function makes the url of.
+    :param id: local file id, the database row id.
+    :param retries: Number of retries made after transient failures.
 
     """
-    def __init__(self, url):
+    __slots__ = ('error', 'uuid', 'upload_token', 'data', 'url', 'id', 'retries')
+
+    def __init__(self, url, id=None):
         self.error = None
         self.uuid = None
         self.upload_token = None
         self.data = None
         self.url = url
-        self.id = uuid4()
+        self.id = id
+        self.retries = 0
 
     @property
     def status(self):
@@ -61,135 +59,269 @@ class File:
 
 class Uploader:
     """An uploader worker.
+
+    Files go through three stages, each with its own concurrency limit
+    and the first two connected with a bounded hand-off queue:
+
+    * submit - `from_url` requests, `settings.MAX_CONCURRENT_UPLOADS`
+      consumers of `upload_queue`, gated by `concurrency` limiter which
+      tunes the actual limit in `settings.AUTO_CONCURRENCY` mode;
+    * poll - waiting for Uploadcare to download the files, up to
+      `settings.MAX_CONCURRENT_STATUS_CHECKS` files tracked by `poller`
+      at once, fed by `status_queue`;
+    * record - events dispatching by `events` bus, synchronously
+      or in batches.
+
+    Transient failures (network errors, 5xx responses, status check
+    timeouts) are retried by `retry_policy`: the file is submitted again
+    after a backoff delay.
     
     :param loop: Uploader event loop.
+    :param client: Upload API client, configured with settings if omitted.
+    :param sign: Function making the `from_url` url of a file url, e.g. signing
+        an S3 key. Called right before every submission, so the signed url
+        is fresh when Uploadcare downloads the file, even after retries.
     :param EVENTS: Set of available events to listen.
-    :param events_callbacks: Registry of events callbacks.
-    :param upload_semaphore: Semaphore for upload tasks.
-    :param status_check_semaphore: Semaphore for status check tasks.
-    :param event_queue: Events queue.
-    :param upload_queue: Upload queue.
+    :param events: Events bus.
+    :param concurrency: Limiter of concurrent upload requests.
+    :param status_check_semaphore: Semaphore for files tracked by the poller.
+    :param poller: Status poller shared by all the uploading files.
+    :param upload_queue: Upload queue, bounded to hold the input back.
+    :param status_queue: Status check queue.
+    :param retry_policy: Retry policy for transient failures.
 
     """
     EVENTS = (Events.UPLOAD_ERROR,
               Events.UPLOAD_THROTTLED,
               Events.UPLOAD_COMPLETE,
+              Events.UPLOAD_RETRY,
               Events.DOWNLOAD_ERROR,
               Events.DOWNLOAD_COMPLETE)
+    # Events after which the file is not processed anymore.
+    FINAL_EVENTS = (Events.UPLOAD_ERROR,
+                    Events.DOWNLOAD_ERROR,
+                    Events.DOWNLOAD_COMPLETE)
 
-    def __init__(self, loop=None):
+    def __init__(self, loop=None, client=None, sign=None):
         if loop is None:
             loop = asyncio.get_event_loop()
-        self._events_callbacks = defaultdict(list)
+        if client is None:
+            client = UploadAPIClient.from_settings()
         self.loop = loop
+        self.client = client
+        self.sign = sign
         # As of 3.10, the `loop`*` parameter was removed
         # since it is no longer necessary.
         # This is a workaround to support old and new versions.
         self.loop_kwargs = {'loop': self.loop} if sys.version_info < (3, 10) else {}
 
-        # Semaphores to avoid too much 'parallel' requests.
-        self._upload_semaphore = asyncio.Semaphore(
-            settings.MAX_CONCURRENT_UPLOADS, **self.loop_kwargs)
-        self.event_queue = asyncio.Queue(**self.loop_kwargs)
-        self.upload_queue = asyncio.Queue(**self.loop_kwargs)
+        # The static limit is the starting point and the ceiling.
+        self.concurrency = ConcurrencyLimiter(
+            settings.MAX_CONCURRENT_UPLOADS,
+            minimum=settings.MIN_CONCURRENT_UPLOADS,
+            adaptive=settings.AUTO_CONCURRENCY,
+            loop=self.loop)
+        # Semaphore to avoid tracking too much files at once.
+        self._status_check_semaphore = asyncio.Semaphore(
+            settings.MAX_CONCURRENT_STATUS_CHECKS, **self.loop_kwargs)
+        self.events = EventBus(self.EVENTS, loop=self.loop)
+        self.upload_queue = asyncio.Queue(settings.STAGE_QUEUE_SIZE, **self.loop_kwargs)
+        self.status_queue = asyncio.Queue(settings.STAGE_QUEUE_SIZE, **self.loop_kwargs)
+        self.poller = StatusPoller(self.client, loop=self.loop)
+        self.retry_policy = RetryPolicy()
+        self._consumers = []
+        self._status_checks = set()
+        self._retries = set()
+        # Number of files taken from the input and not finished yet.
+        self._in_flight = 0
+        self._idle = asyncio.Event(**self.loop_kwargs)
 
     async def upload(self, file):
         """Upload file using `from_url` feature.
+
+        Throttled requests are retried right away: the shared rate limiter
+        holds them back till `Retry-After` passes. Successfully submitted
+        files are handed off to the poll stage.
         
         :param file: `File` instance.
         
         """
-        async with self._upload_semaphore:
-            data = {'source_url': file.url, 'store': 'auto'}
-            response = await request('from_url/', data)
-            event = {'file': file}
-
+        while True:
+            async with self.concurrency:
+                started = self.loop.time()
+                try:
+                    url = self.sign(file.url) if self.sign else file.url
+                    response = await self.client.from_url(url)
+                except TRANSIENT_ERRORS as e:
+                    self.concurrency.failed()
+                    return self.retry(file, 'UPLOAD_ERROR: {0!r}'.format(e),
+                                      Events.UPLOAD_ERROR)
+                except Exception:
+                    self.concurrency.failed()
+                    raise
             if response.status == 429:
-                event['type'] = Events.UPLOAD_THROTTLED
-                timeout = response.headers.get('Retry-After',
-                                               settings.THROTTLING_TIMEOUT)
-                await asyncio.sleep(float(timeout), **self.loop_kwargs)
+                self.concurrency.throttled()
+                event_type = Events.UPLOAD_THROTTLED
+            elif is_transient_status(response.status):
+                self.concurrency.failed()
+                return self.retry(file, 'UPLOAD_ERROR: {0}'.format(await response.text()),
+                                  Events.UPLOAD_ERROR)
             elif response.status != 200:
                 file.error = 'UPLOAD_ERROR: {0}'.format(await response.text())
-                event['type'] = Events.UPLOAD_ERROR
+                event_type = Events.UPLOAD_ERROR
             else:
+                self.concurrency.succeeded(self.loop.time() - started)
                 file.upload_token = (await response.json())['token']
-                event['type'] = Events.UPLOAD_COMPLETE
+                event_type = Events.UPLOAD_COMPLETE
             # Create event.
-            asyncio.ensure_future(self.event_queue.put(event), loop=self.loop)
+            self.emit(event_type, file)
 
-            if event['type'] == Events.UPLOAD_THROTTLED:
-                # Put item back to queue since it need to be retried
-                await self.upload_queue.put(file)
-            elif event['type'] != Events.UPLOAD_ERROR:
-                await self.wait_for_status(file)
-            # Mark file as processed from upload queue.
-            self.upload_queue.task_done()
+            if event_type != Events.UPLOAD_THROTTLED:
+                break
 
-            return None
+        if event_type != Events.UPLOAD_ERROR:
+            await self.status_queue.put(file)
+        return None
 
     async def wait_for_status(self, file):
         """Wait till `file` will be processed by Uploadcare or 
         `settings.FROM_URL_TIMEOUT` seconds before timeout.
+
+        Status checks are made by the shared `StatusPoller`.
         
         :param file: `File` instance.
     
         """
-        start = time.time()
-        event = {'file': file}
-        data = {'token': file.upload_token}
-        while time.time() - start <= settings.FROM_URL_TIMEOUT:
-            response = await request('from_url/status/', data)
-            if response.status != 200:
-                event['type'] = Events.DOWNLOAD_ERROR
-                file.error = 'Request error: {0}'.format(response.status)
-                break
-            else:
-                result = await response.json()
-                if result['status'] == 'error':
-                    event['type'] = Events.DOWNLOAD_ERROR
-                    file.error = result.get('error', 'unknown')
-                    break
-                elif result['status'] == 'success':
-                    event['type'] = Events.DOWNLOAD_COMPLETE
-                    file.data = result
-                    file.uuid = result['uuid']
-                    break
-                else:
-                    await asyncio.sleep(settings.STATUS_CHECK_INTERVAL,
-                                        **self.loop_kwargs)
+        outcome = await self.poller.wait(file)
+        if outcome == StatusPoller.SUCCESS:
+            self.emit(Events.DOWNLOAD_COMPLETE, file)
+        elif outcome == StatusPoller.TIMEOUT:
+            self.retry(file, file.error, Events.DOWNLOAD_ERROR)
         else:
-            # `from_url` timeout.
-            event['type'] = Events.DOWNLOAD_ERROR
-            file.error = 'Status check timeout.'
+            self.emit(Events.DOWNLOAD_ERROR, file)
+        return None
+
+    def retry(self, file, error, event_type):
+        """Retry `file` upload after a transient failure.
+
+        The file is submitted again after `retry_policy` backoff delay,
+        when it's out of retries `event_type` event is created.
+
+        :param file: `File` instance.
+        :param error: Failure description.
+        :param event_type: Event to create when the file can't be retried.
+
+        """
+        file.error = error
+        if not self.retry_policy.should_retry(file):
+            self.emit(event_type, file)
+            return None
 
-        # Mark file as processed from status check queue.
-        asyncio.ensure_future(self.event_queue.put(event), loop=self.loop)
+        file.retries += 1
+        self.emit(Events.UPLOAD_RETRY, file)
+        delay = self.retry_policy.delay(file.retries)
+        resubmit = asyncio.ensure_future(self._resubmit(file, delay), loop=self.loop)
+        self._retries.add(resubmit)
+        resubmit.add_done_callback(self._retries.discard)
+        return None
+
+    async def _resubmit(self, file, delay):
+        await asyncio.sleep(delay, **self.loop_kwargs)
+        file.error = None
+        file.upload_token = None
+        await self.upload_queue.put(file)
         return None
 
     async def process_upload_queue(self):
-        """Upload queue process coroutine."""
+        """Upload queue process coroutine, a consumer of the submit stage."""
         while True:
             file = await self.upload_queue.get()
-            asyncio.ensure_future(self.upload(file), loop=self.loop)
+            try:
+                await self.upload(file)
+            except Exception as e:
+                # Keep the consumer alive, the file is failed.
+                file.error = 'UPLOAD_ERROR: {0!r}'.format(e)
+                self.emit(Events.UPLOAD_ERROR, file)
+            finally:
+                # Mark file as processed from upload queue.
+                self.upload_queue.task_done()
+        return None
+
+    async def process_status_queue(self):
+        """Status queue process coroutine, the poll stage dispatcher."""
+        while True:
+            file = await self.status_queue.get()
+            await self._status_check_semaphore.acquire()
+            check = asyncio.ensure_future(self._check_status(file), loop=self.loop)
+            self._status_checks.add(check)
+            check.add_done_callback(self._status_checks.discard)
+        return None
+
+    async def _check_status(self, file):
+        try:
+            await self.wait_for_status(file)
+        except Exception as e:
+            file.error = 'Request error: {0!r}'.format(e)
+            self.emit(Events.DOWNLOAD_ERROR, file)
+        finally:
+            self._status_check_semaphore.release()
+            # Mark file as processed from status queue.
+            self.status_queue.task_done()
         return None
 
     async def process(self, urls):
         """Process `urls` - upload specified urls to Uploadcare.
+
+        `urls` are consumed lazily: the bounded upload queue holds
+        the producer back while the stages are busy, so the number of
+        files in memory doesn't depend on the number of `urls`.
         
-        :param urls: List of URL's to upload to Uploadcare.
+        :param urls: Iterable or async iterable of URL's or `File`
+            instances to upload to Uploadcare.
         
         """
         self._consumers = [
-            asyncio.ensure_future(self.process_events(), loop=self.loop),
-            asyncio.ensure_future(self.process_upload_queue(), loop=self.loop),
+            asyncio.ensure_future(self.flush_events(), loop=self.loop),
+            asyncio.ensure_future(self.process_status_queue(), loop=self.loop),
+            asyncio.ensure_future(self.poller.run(), loop=self.loop),
         ]
-        for url in urls:
-            # Put jobs into upload queue.
-            await self.upload_queue.put(File(url))
+        self._consumers.extend(
+            asyncio.ensure_future(self.process_upload_queue(), loop=self.loop)
+            for _ in range(settings.MAX_CONCURRENT_UPLOADS)
+        )
+        if hasattr(urls, '__aiter__'):
+            async for url in urls:
+                # Put jobs into upload queue.
+                await self._put(url)
+        else:
+            for url in urls:
+                await self._put(url)
+
+        # Wait till all the files are finished, retried files
+        # may go through the stages several times.
+        while self._in_flight:
+            self._idle.clear()
+            await self._idle.wait()
+        self.events.flush()
+        return None
+
+    async def _put(self, url):
+        file = url if isinstance(url, File) else File(url)
+        self._in_flight += 1
+        await self.upload_queue.put(file)
 
-        # Wait till all queues are processed
-        await self.upload_queue.join()
+    def emit(self, event_type, file):
+        """Dispatch `event_type` event of `file`.
+
+        :param event_type: `Events` member.
+        :param file: `File` instance.
+
+        """
+        self.events.emit(event_type, file)
+        if event_type in self.FINAL_EVENTS:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
         return None
 
     def shutdown(self):
@@ -198,30 +330,29 @@ class Uploader:
         Stop all consumers, wait till they stop.
         
         """
-        for consumer in self._consumers:
-            consumer.cancel()
-        try:
-            # Wait till started consumers tasks will finish.
-            self.loop.run_until_complete(asyncio.gather(*self._consumers,
-                                                        **self.loop_kwargs))
-        except asyncio.CancelledError:
-            pass
+        self.poller.stop()
+        self.events.flush()
+        tasks = self._consumers + list(self._status_checks) + list(self._retries)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            # Wait till started consumers tasks will finish, a task stuck
+            # despite the cancellation doesn't block the exit.
+            self.loop.run_until_complete(asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT))
+            for task in tasks:
+                if task.done() and not task.cancelled():
+                    # Retrieve the errors, so they aren't reported as never retrieved.
+                    task.exception()
 
         # Remove all the queues consumers.
         self._consumers = []
         return None
 
-    async def process_events(self):
-        """Events process coroutine."""
+    async def flush_events(self):
+        """Periodically flush events collected for batch callbacks."""
         while True:
-            event = await self.event_queue.get()
-            event_type = event['type']
-            callbacks = self._events_callbacks[event_type]
-            for callback in callbacks:
-                if asyncio.iscoroutinefunction(callback):
-                    asyncio.ensure_future(callback(event), loop=self.loop)
-                else:
-                    callback(event)
+            await asyncio.sleep(settings.EVENTS_FLUSH_INTERVAL, **self.loop_kwargs)
+            self.events.flush()
         return None
 
     def on(self, *events, callback):
@@ -235,11 +366,22 @@ class Uploader:
         :param callback: Callback to register. 
         
         """
-        for event in events:
-            if event not in self.EVENTS:
-                raise TypeError('Unknown event')
+        self.events.on(*events, callback=callback)
+        return None
 
-            self._events_callbacks[event].append(callback)
+    def on_batch(self, *events, callback, size=None):
+        """Register batch `callback` for `event`.
+
+        The callback is called with a list of events, when `size` events
+        are collected or every `settings.EVENTS_FLUSH_INTERVAL` seconds.
+
+        :param event: Event instance.
+        :param callback: Callback to register.
+        :param size: Maximum number of events in a batch.
+
+        """
+        self.events.on_batch(*events, callback=callback,
+                             size=size or settings.EVENTS_BATCH_SIZE)
         return None
 
     def off(self, *events, callback=None):
@@ -249,15 +391,5 @@ class Uploader:
         :param callback: Callback to unregister.
         
         """
-        for event in events:
-            if event not in self.EVENTS:
-                raise TypeError('Unknown event')
-
-            if event in self._events_callbacks:
-                if callback:
-                    callbacks = self._events_callbacks[event]
-                    if callback in callbacks:
-                        callbacks.remove(callback)
-                else:
-                    del self._events_callbacks[event]
+        self.events.off(*events, callback=callback)
         return None
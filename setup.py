@@ -42,6 +42,10 @@ setup(
         'botocore==1.34.80',
         'python-dotenv==1.0.1'
     ],
+    extras_require={
+        # ORC and Parquet S3 Inventory reports.
+        'inventory': ['pyarrow'],
+    },
     include_package_data=True,
     classifiers=[
         'Development Status :: 5 - Production/Stable',
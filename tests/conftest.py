@@ -1,9 +1,7 @@
-import asyncio
-
 import pytest
 
-from migro.uploader import utils
-from migro.uploader.utils import session
+from db.db_manager import DBManager
+from migro.uploader.client import UploadAPIClient
 
 
 class MockResponse:
@@ -14,6 +12,9 @@ class MockResponse:
     async def json(self):
         return self._json
 
+    async def text(self):
+        return str(self._json)
+
     async def __aexit__(self, exc_type, exc, tb):
         pass
 
@@ -21,7 +22,7 @@ class MockResponse:
         return self
 
 
-class Session:
+class Transport:
     def __init__(self, response):
         self._response = response
 
@@ -30,9 +31,7 @@ class Session:
 
 
 @pytest.fixture
-def mock_session():
-    original_session = utils.session
-
+def mock_client():
     fake_response = MockResponse(
         json={
             'token': 'token',
@@ -41,13 +40,11 @@ def mock_session():
         },
         status=200,
     )
-    utils.session = Session(fake_response)
+    return UploadAPIClient('public', transport=Transport(fake_response))
 
-    yield
 
-    utils.session = original_session
-
-
-@pytest.fixture(scope='session', autouse=True)
-def close_session():
-    asyncio.ensure_future(session.close())
+@pytest.fixture
+def db_manager(tmp_path):
+    manager = DBManager(tmp_path / 'migration.db', verbose=False)
+    yield manager
+    manager.close_connection()
@@ -0,0 +1,456 @@
+import asyncio
+import sqlite3
+import time
+
+from db.async_db_manager import AsyncDBManager
+from db.db_manager import DBManager
+from db.journal import Journal
+from migro import settings
+from migro.uploader.processes import ProgressQueue, WorkerPool, worker_settings
+from migro.uploader.utils import loop
+
+
+def test_claim_files(db_manager):
+    for number in range(10):
+        db_manager.insert_file(f'http://file-url/{number}', 'urls')
+    attempt = db_manager.start_attempt('urls', 10)
+    db_manager.set_attempt_for_files(attempt)
+
+    # Another process working with the same database.
+    other = DBManager(db_manager.db_file, verbose=False, worker=1)
+    claimed = [
+        db_manager.claim_files(attempt, 'first', 4),
+        other.claim_files(attempt, 'second', 4),
+        db_manager.claim_files(attempt, 'third', 4),
+        other.claim_files(attempt, 'fourth', 4),
+    ]
+    other.close_connection()
+
+    assert [len(rows) for rows in claimed] == [4, 4, 2, 0]
+    paths = [path for rows in claimed for _, path in rows]
+    assert sorted(paths) == sorted(f'http://file-url/{number}' for number in range(10))
+
+    # Files of a new attempt can be claimed again, except the uploaded ones.
+    db_manager.set_file_uploaded(1, attempt, 'file-uuid')
+    attempt = db_manager.start_attempt('urls', 9)
+    db_manager.set_attempt_for_files(attempt)
+    assert len(db_manager.claim_files(attempt, 'fifth', 100)) == 9
+
+
+def test_worker_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'WORKERS', 4)
+    monkeypatch.setattr(settings, 'MAX_CONCURRENT_UPLOADS', 10)
+    monkeypatch.setattr(settings, 'REQUESTS_PER_SECOND', 10.0)
+    monkeypatch.setattr(settings, 'STAGE_QUEUE_SIZE', 2)
+
+    options = [worker_settings(4, number) for number in range(4)]
+
+    assert options[0]['WORKERS'] == 1
+    # The parts add up to the limit.
+    assert [worker['MAX_CONCURRENT_UPLOADS'] for worker in options] == [3, 3, 2, 2]
+    assert options[0]['REQUESTS_PER_SECOND'] == 2.5
+    assert [worker['STAGE_QUEUE_SIZE'] for worker in options] == [1, 1, 1, 1]
+    # The status check rate grows with the files waiting for their status, so it isn't split.
+    assert options[0]['STATUS_CHECK_RATE'] == settings.STATUS_CHECK_RATE
+    assert options[0]['FROM_URL_TIMEOUT'] == settings.FROM_URL_TIMEOUT
+
+
+def test_worker_progress():
+    rows, counts, postfixes = [], [], []
+    pool = WorkerPool(2, 'urls', 1, report=rows.extend)
+    progress = ProgressQueue(pool.progress, 1)
+    progress.update(2)
+    progress.write_report(iter([('kittens.jpg', 1, 'file-uuid', 'uploaded', None)]))
+    progress.set_postfix(concurrency=5, refresh=False)
+    # Unchanged values aren't passed again.
+    progress.set_postfix(concurrency=5, refresh=False)
+    ProgressQueue(pool.progress, 0).set_postfix(concurrency=3, refresh=False)
+    progress.update(1)
+    time.sleep(0.1)
+
+    bar = type('Bar', (), {'update': lambda self, count: counts.append(count),
+                           'set_postfix': lambda self, refresh, **kwargs: postfixes.append(kwargs)})()
+    pool._update(bar, timeout=1)
+
+    assert counts == [2, 1]
+    assert rows == [('kittens.jpg', 1, 'file-uuid', 'uploaded', None)]
+    assert postfixes == [{'concurrency': '5'}, {'concurrency': '3/5'}]
+
+
+def test_insert_files(db_manager):
+    files = ((f'key/{number}', number, None) for number in range(25))
+    assert db_manager.insert_files(files, 's3', chunk_size=10) == 25
+
+    # Known files are skipped, the same path of another source is not.
+    files = [('key/0', 0, None), ('key/25', 25, None), ('key/25', 25, None)]
+    assert db_manager.insert_files(files, 's3') == 1
+    assert db_manager.insert_files([('key/0', 0, None)], 'urls') == 1
+    assert db_manager.count_pending_files('s3') == 26
+    assert db_manager.count_pending_files('urls') == 1
+
+
+def test_migrations(tmp_path):
+    # Database of the first version, before the migrations.
+    db_file = tmp_path / 'migration.db'
+    conn = sqlite3.connect(db_file)
+    conn.executescript("""
+    CREATE TABLE attempts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        files_count INTEGER NOT NULL,
+        successful_uploads INTEGER NULL,
+        failed_uploads INTEGER NULL,
+        started_at DATETIME,
+        finished_at DATETIME NULL,
+        error BOOLEAN DEFAULT 0
+    );
+    CREATE TABLE files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        path TEXT NOT NULL,
+        source TEXT NOT NULL,
+        file_size INTEGER,
+        uploadcare_uuid TEXT,
+        status TEXT NOT NULL,
+        error TEXT,
+        last_attempt_id INTEGER,
+        last_updated DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(last_attempt_id) REFERENCES attempts(id)
+    );
+    INSERT INTO files (path, source, status) VALUES ('key', 's3', 'pending');
+    INSERT INTO files (path, source, status) VALUES ('key', 's3', 'pending');
+    """)
+    conn.close()
+
+    manager = DBManager(db_file, verbose=False)
+    assert manager.conn.execute("PRAGMA user_version").fetchone()[0] == len(DBManager.MIGRATIONS)
+    assert manager.count_pending_files('s3') == 1
+    manager.insert_file('key', 's3')
+    assert manager.count_pending_files('s3') == 1
+    manager.set_file_error(1, 'error', retries=2)
+
+    plan = manager.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT path FROM files WHERE status IN ('pending', 'error') AND source = ?",
+        ('s3',)).fetchall()
+    assert 'idx_files_source_status' in str(plan)
+    manager.close_connection()
+
+    # Up to date database is left as is.
+    manager = DBManager(db_file, verbose=False)
+    assert manager.conn.execute("SELECT retries FROM files").fetchall() == [(2,)]
+    manager.close_connection()
+
+
+def test_buffered_updates(tmp_path):
+    db_file = tmp_path / 'migration.db'
+    manager = DBManager(db_file, verbose=False, buffer_size=3, flush_interval=60)
+    assert manager.conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    manager.insert_files(((f'key/{number}', None, None) for number in range(5)), 's3')
+    reader = DBManager(db_file, verbose=False, journal=False)
+
+    def statuses():
+        return dict(reader.conn.execute("SELECT path, status FROM files").fetchall())
+
+    manager.set_file_uploaded(1, 1, 'file-uuid')
+    manager.set_file_error(2, 'error')
+    assert set(statuses().values()) == {'pending'}
+
+    # Full buffer is written at once.
+    manager.set_file_uploaded(3, 1, 'file-uuid')
+    assert statuses() == {'key/0': 'uploaded', 'key/1': 'error', 'key/2': 'uploaded',
+                          'key/3': 'pending', 'key/4': 'pending'}
+
+    # Queries of the manager itself see its buffered updates.
+    manager.set_file_uploaded(4, 1, 'file-uuid')
+    assert manager.count_pending_files('s3') == 2
+
+    manager.set_file_uploaded(5, 1, 'file-uuid')
+    manager.close_connection()
+    assert statuses()['key/4'] == 'uploaded'
+    reader.close_connection()
+
+
+def test_attempt_lifecycle(db_manager):
+    db_manager.insert_files(((f'key/{number}', number, None) for number in range(6)), 's3')
+    db_manager.insert_files([('http://file-url', None, None)], 'urls')
+    attempt = db_manager.start_attempt('s3', 6)
+    assert db_manager.set_attempt_for_files(attempt) == 6
+
+    db_manager.set_file_uploaded(1, attempt, 'file-uuid')
+    db_manager.set_file_uploaded(2, attempt, 'file-uuid')
+    db_manager.set_file_error(3, 'error')
+    files, attempt_id, uploaded, failed = db_manager.finish_attempt(attempt)
+
+    assert (attempt_id, uploaded, failed) == (attempt, 2, 1)
+    assert len(list(files)) == 6
+    reader = DBManager(db_manager.db_file, verbose=False, journal=False)
+    assert reader.get_attempt_by_id(attempt)[3:5] == (2, 1)
+    reader.close_connection()
+
+    # Failed files are skipped on request.
+    attempt = db_manager.start_attempt('s3', 3)
+    assert db_manager.set_attempt_for_files(attempt, ignore_errors=True) == 3
+    files, _, uploaded, failed = db_manager.finish_attempt(attempt)
+    assert (len(list(files)), uploaded, failed) == (3, 0, 0)
+
+
+def test_filtered_attempt(db_manager):
+    db_manager.insert_files(((f'key/{number}', number, None) for number in range(6)), 's3')
+    db_manager.insert_files([('other/0', 0, None), ('key0/0', 0, None), ('key/6', None, None)], 's3')
+    db_manager.set_file_error(1, 'error')
+
+    def file_filter(path):
+        return int(path[-1]) % 2 == 0
+
+    attempt = db_manager.start_attempt('s3', 0)
+    assert db_manager.set_attempt_for_files(attempt, prefix='key/', min_size=1, max_size=4,
+                                            file_filter=file_filter) == 3
+    # Only the files of the attempt are uploaded, other pending files are left.
+    pages = db_manager.get_pending_files_page('s3', 0, 10, attempt_id=attempt)
+    assert [path for _, path, _ in pages] == ['key/2', 'key/4', 'key/6']
+    assert db_manager.count_pending_files('s3') == 9
+    assert db_manager.get_attempt_by_id(attempt)[2] == 3
+
+    # The prefix and the sizes are checked by SQLite, no function is called.
+    attempt = db_manager.start_attempt('s3', 0)
+    db_manager.conn.create_function('file_filter', 1, None)
+    assert db_manager.set_attempt_for_files(attempt, prefix='key', max_size=0) == 3
+
+
+def test_filtered_duplicates(db_manager):
+    db_manager.insert_files([
+        ('a/kittens.jpg', 100, 'etag-1'),
+        ('b/kittens.jpg', 100, 'etag-1'),
+        ('b/copy.jpg', 100, 'etag-1'),
+    ], 's3')
+    assert db_manager.mark_duplicates('s3') == 2
+
+    # The original is left out by the filter, the first of its copies is uploaded instead.
+    attempt = db_manager.start_attempt('s3', 0)
+    assert db_manager.set_attempt_for_files(attempt, prefix='b/') == 1
+    assert [path for _, path, _ in db_manager.get_pending_files_page('s3', 0, 10, attempt_id=attempt)] == [
+        'b/kittens.jpg']
+    # So is a copy of a file left out, listed during the attempt.
+    db_manager.insert_files([('a/new.jpg', 200, 'etag-2')], 's3')
+    assert db_manager.insert_listed_files(
+        's3', 'bucket', 'b/', [('b/new.jpg', 200, 'etag-2')], [], 'b/new.jpg', attempt) == (1, 0)
+    assert [path for _, path, _ in db_manager.get_pending_files_page('s3', 0, 10, attempt_id=attempt)] == [
+        'b/kittens.jpg', 'b/new.jpg']
+
+    db_manager.set_file_uploaded(2, attempt, 'kittens-uuid')
+    files, _, uploaded, failed = db_manager.finish_attempt(attempt)
+    statuses = {path: (status, uuid) for path, _, uuid, status, _ in files}
+    assert statuses['b/copy.jpg'] == ('uploaded', 'kittens-uuid')
+    assert 'a/kittens.jpg' not in statuses
+
+
+def test_iter_pending_files(db_manager):
+    db_manager.insert_files(((f'key/{number}', number, None) for number in range(10)), 's3')
+    db_manager.set_file_uploaded(2, 1, 'file-uuid')
+    db_manager.set_file_error(3, 'error')
+
+    files = db_manager.iter_pending_files('s3', chunk_size=3)
+    assert next(files) == (1, 'key/0', 0)
+    # Files updated while iterating don't change the rest of the pages.
+    db_manager.set_file_uploaded(1, 1, 'file-uuid')
+    db_manager.set_file_uploaded(10, 1, 'file-uuid')
+    assert [path for _, path, _ in files] == [f'key/{number}' for number in (2, 3, 4, 5, 6, 7, 8)]
+
+    pending = [path for _, path, _ in db_manager.iter_pending_files('s3', include_errors=False)]
+    assert pending == [f'key/{number}' for number in range(3, 9)]
+
+
+class SlowDBManager(DBManager):
+    """Database on a slow disk."""
+    def set_file_uploaded(self, *args, **kwargs):
+        time.sleep(0.1)
+        super().set_file_uploaded(*args, **kwargs)
+
+
+def measure_loop_lag(record):
+    """Maximum delay of a loop heartbeat while `record` records uploaded files."""
+    async def heartbeat(lags, done):
+        while not done.is_set():
+            started = time.monotonic()
+            await asyncio.sleep(0.005)
+            lags.append(time.monotonic() - started - 0.005)
+
+    async def upload(done):
+        for number in range(10):
+            record(number + 1, 1, 'file-uuid')
+            await asyncio.sleep(0.01)
+        done.set()
+
+    async def main():
+        lags, done = [], asyncio.Event()
+        await asyncio.gather(heartbeat(lags, done), upload(done))
+        return max(lags)
+
+    return loop.run_until_complete(main())
+
+
+def test_async_db_manager_loop_lag(tmp_path):
+    manager = SlowDBManager(tmp_path / 'migration.db', verbose=False)
+    manager.insert_files(((f'key/{number}', None, None) for number in range(10)), 's3')
+
+    blocking_lag = measure_loop_lag(manager.set_file_uploaded)
+    db = AsyncDBManager(manager)
+    async_lag = measure_loop_lag(db.set_file_uploaded)
+    db.join()
+
+    assert blocking_lag >= 0.1
+    assert async_lag < 0.05
+    assert manager.count_pending_files('s3') == 0
+    db.close()
+    manager.close_connection()
+
+
+def test_async_db_manager_iterate(db_manager):
+    db_manager.insert_files(((f'key/{number}', None, None) for number in range(5)), 's3')
+    db = AsyncDBManager(db_manager)
+
+    async def read():
+        pending = db_manager.iter_pending_files('s3', chunk_size=2)
+        return [path async for _, path, _ in db.iterate(pending, chunk_size=2)]
+
+    assert loop.run_until_complete(read()) == [f'key/{number}' for number in range(5)]
+    db.close()
+
+
+def test_async_db_manager_flush_periodically(tmp_path):
+    db_file = tmp_path / 'migration.db'
+    manager = DBManager(db_file, verbose=False, flush_interval=0.05)
+    manager.insert_files([('key/0', None, None)], 's3')
+    reader = DBManager(db_file, verbose=False, journal=False)
+    rows = []
+    manager.on_flush = rows.extend
+    db = AsyncDBManager(manager)
+
+    async def stall():
+        flushing = asyncio.ensure_future(db.flush_periodically())
+        await db.run(manager.set_file_uploaded, 1, 1, 'file-uuid')
+        # No more updates arrive, the buffered one is written anyway.
+        await asyncio.sleep(0.2)
+        flushing.cancel()
+
+    loop.run_until_complete(stall())
+    assert reader.conn.execute("SELECT status FROM files").fetchone()[0] == 'uploaded'
+    assert rows == [('key/0', None, 'file-uuid', 'uploaded', None)]
+    db.close()
+    manager.close_connection()
+    reader.close_connection()
+
+
+def test_journal_replay(tmp_path):
+    db_file = tmp_path / 'migration.db'
+    manager = DBManager(db_file, verbose=False, buffer_size=2, flush_interval=60)
+    manager.insert_files(((f'key/{number}', None, None) for number in range(5)), 's3')
+    manager.set_file_uploaded(1, 1, 'file-uuid', retries=1)
+    manager.set_file_uploaded(2, 1, 'file-uuid')
+    manager.set_file_error(3, 'error', retries=2)
+    # The worker process is killed before its updates are written.
+    worker = DBManager(db_file, verbose=False, buffer_size=10, flush_interval=60, worker=0)
+    worker.set_file_uploaded(4, 1, 'file-uuid')
+    worker.journal.file.write('["uploaded","file-u')
+    worker.journal.file.flush()
+    # Simulate the main process being killed too.
+    manager.journal.file.close()
+    manager.conn.close()
+    worker.journal.file.close()
+    worker.conn.close()
+
+    assert len(Journal.read(db_file.with_suffix('.journal'))) == 1
+    manager = DBManager(db_file, verbose=False)
+    rows = manager.conn.execute("SELECT status, retries FROM files ORDER BY id").fetchall()
+    assert rows == [('uploaded', 1), ('uploaded', 0), ('error', 2), ('uploaded', 0), ('pending', 0)]
+    assert not db_file.with_suffix('.0.journal').exists()
+    manager.close_connection()
+    assert not db_file.with_suffix('.journal').exists()
+
+
+def test_journal_replay_after_commit(tmp_path):
+    db_file = tmp_path / 'migration.db'
+    manager = DBManager(db_file, verbose=False, flush_interval=60)
+    manager.insert_files([('key/0', None, None)], 's3')
+    manager.set_file_error(1, 'error', retries=2)
+    manager.flush()
+    manager.set_file_uploaded(1, 2, 'file-uuid', retries=1)
+    # The process is killed after the updates are committed, before the journal is.
+    manager.journal.commit = lambda: None
+    manager.flush()
+    manager.journal.file.close()
+    manager.conn.close()
+
+    manager = DBManager(db_file, verbose=False)
+    # Retries of both attempts are counted once.
+    assert manager.conn.execute("SELECT status, retries FROM files").fetchone() == ('uploaded', 3)
+    manager.close_connection()
+
+
+def test_journal_compaction(tmp_path):
+    db_file = tmp_path / 'migration.db'
+    manager = DBManager(db_file, verbose=False, buffer_size=2, compact_size=5)
+    manager.insert_files(((f'key/{number}', None, None) for number in range(4)), 's3')
+    for file_id in range(1, 5):
+        manager.set_file_uploaded(file_id, 1, 'file-uuid')
+    # 2 commits of 2 updates each are compacted.
+    assert manager.journal.size == 0
+    manager.close_connection()
+
+
+def test_duplicates(db_manager):
+    db_manager.insert_files([
+        ('kittens.jpg', 100, 'etag-1'),
+        ('raccoons.jpg', 200, 'etag-2'),
+        ('copy/kittens.jpg', 100, 'etag-1'),
+        ('copy/raccoons.jpg', 200, 'etag-2'),
+        ('other.jpg', 300, 'etag-1'),
+        ('no-etag.jpg', 100, None),
+    ], 's3')
+    assert db_manager.mark_duplicates('s3') == 2
+    assert db_manager.count_pending_files('s3') == 4
+
+    attempt = db_manager.start_attempt('s3', 4)
+    db_manager.set_attempt_for_files(attempt)
+    assert [path for _, path, _ in db_manager.iter_pending_files('s3')] == [
+        'kittens.jpg', 'raccoons.jpg', 'other.jpg', 'no-etag.jpg']
+    db_manager.set_file_uploaded(1, attempt, 'kittens-uuid')
+    db_manager.set_file_error(2, 'error')
+    files, _, uploaded, failed = db_manager.finish_attempt(attempt)
+    statuses = {path: (status, uuid) for path, _, uuid, status, _ in files}
+    assert statuses['copy/kittens.jpg'] == ('uploaded', 'kittens-uuid')
+    assert statuses['copy/raccoons.jpg'] == ('error', None)
+    assert (uploaded, failed) == (2, 2)
+
+    # Copies of files uploaded by previous attempts aren't uploaded again.
+    db_manager.insert_files([('new/kittens.jpg', 100, 'etag-1')], 's3')
+    assert db_manager.mark_duplicates('s3') == 2
+    attempt = db_manager.start_attempt('s3', 3)
+    db_manager.set_attempt_for_files(attempt)
+    files, _, uploaded, failed = db_manager.finish_attempt(attempt)
+    statuses = {path: (status, uuid) for path, _, uuid, status, _ in files}
+    assert statuses['new/kittens.jpg'] == ('uploaded', 'kittens-uuid')
+
+    plan = db_manager.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT MIN(id) FROM files WHERE source = ? AND etag = ? AND file_size IS ?",
+        ('s3', 'etag-1', 100)).fetchall()
+    assert 'idx_files_etag' in str(plan)
+
+
+def test_listing(db_manager):
+    assert db_manager.get_listing('bucket') == []
+    assert db_manager.start_listing('bucket', ['']) == [('', 0, None)]
+
+    attempt = db_manager.start_attempt('s3', 0)
+    files = [('a.jpg', 100, 'etag-1'), ('b.jpg', 100, 'etag-1')]
+    assert db_manager.insert_listed_files('s3', 'bucket', '', files, [('c/', 1)], 'c/', attempt) == (1, 1)
+    assert db_manager.get_listing('bucket') == [('', 0, 'c/'), ('c/', 1, None)]
+    assert db_manager.get_attempt_by_id(attempt)[2] == 1
+    assert [path for _, path, _ in db_manager.iter_pending_files('s3')] == ['a.jpg']
+
+    # Pages listed again on resume don't add files.
+    assert db_manager.insert_listed_files('s3', 'bucket', '', files, [], 'c/', attempt) == (0, 0)
+    db_manager.finish_listing('bucket', '')
+    assert db_manager.get_listing('bucket') == [('c/', 1, None)]
+    db_manager.finish_listing('bucket', 'c/')
+    assert db_manager.get_listing('bucket') == []
+    assert db_manager.start_listing('bucket', ['a', 'b']) == [('a', 0, None), ('b', 0, None)]
@@ -0,0 +1,91 @@
+import csv
+import gzip
+import json
+import sys
+from datetime import datetime
+
+import pytest
+
+from migro.uploader.filters import ObjectFilter
+from migro.uploader.inventory import Inventory, InventoryError
+
+SCHEMA = 'Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, ETag'
+
+
+def write_inventory(folder, data_files, file_format='CSV', schema=SCHEMA):
+    """Write an inventory report the way S3 lays it out."""
+    manifest_folder = folder / '2024-05-06T00-00Z'
+    data_folder = folder / 'data'
+    manifest_folder.mkdir(parents=True)
+    data_folder.mkdir()
+    files = []
+    for name, rows in data_files.items():
+        with gzip.open(data_folder / name, 'wt', newline='') as f:
+            csv.writer(f, quoting=csv.QUOTE_ALL).writerows(rows)
+        files.append({'key': f'inventory/bucket/config/data/{name}', 'size': 1, 'MD5checksum': ''})
+    manifest = manifest_folder / 'manifest.json'
+    manifest.write_text(json.dumps({
+        'sourceBucket': 'bucket',
+        'destinationBucket': 'arn:aws:s3:::inventory',
+        'fileFormat': file_format,
+        'fileSchema': schema,
+        'files': files,
+    }))
+    return manifest
+
+
+def test_csv_inventory(tmp_path):
+    manifest = write_inventory(tmp_path, {
+        'first.csv.gz': [
+            ['bucket', 'kittens.jpg', 'v1', 'true', 'false', '100', 'etag-1'],
+            ['bucket', 'my+kittens%2B%C3%BC.jpg', 'v1', 'true', 'false', '200', 'etag-2'],
+            ['bucket', 'deleted.jpg', 'v2', 'true', 'true', '', ''],
+            ['bucket', 'deleted.jpg', 'v1', 'false', 'false', '300', 'etag-3'],
+        ],
+        'second.csv.gz': [
+            ['bucket', 'raccoons.jpg', 'v1', 'true', 'false', '400', 'etag-4'],
+        ],
+    })
+
+    inventory = Inventory(manifest)
+
+    assert inventory.source_bucket == 'bucket'
+    assert list(inventory.get_objects()) == [
+        ('kittens.jpg', 100, 'etag-1'),
+        ('my kittens+ü.jpg', 200, 'etag-2'),
+        ('raccoons.jpg', 400, 'etag-4'),
+    ]
+
+
+def test_csv_inventory_minimal_schema(tmp_path):
+    manifest = write_inventory(tmp_path, {'data.csv.gz': [['bucket', 'kittens.jpg']]}, schema='Bucket, Key')
+
+    assert list(Inventory(manifest).get_objects()) == [('kittens.jpg', None, None)]
+
+
+def test_inventory_errors(tmp_path, monkeypatch):
+    manifest = write_inventory(tmp_path, {'data.csv.gz': []})
+    (tmp_path / 'data' / 'data.csv.gz').unlink()
+    with pytest.raises(InventoryError):
+        list(Inventory(manifest).get_objects())
+
+    manifest.write_text('{"sourceBucket": "bucket"}')
+    with pytest.raises(InventoryError):
+        Inventory(manifest)
+
+    manifest = write_inventory(tmp_path / 'parquet', {'data.parquet': []}, file_format='Parquet')
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    with pytest.raises(InventoryError, match='pyarrow'):
+        list(Inventory(manifest).get_objects())
+
+
+def test_filtered_inventory(tmp_path):
+    manifest = write_inventory(tmp_path, {'data.csv.gz': [
+        ['bucket', 'photos/kittens.jpg', '100', '2024-05-06T00:00:00.000Z'],
+        ['bucket', 'photos/old.jpg', '100', '2020-05-06T00:00:00.000Z'],
+        ['bucket', 'photos/huge.jpg', '100000', '2024-05-06T00:00:00.000Z'],
+        ['bucket', 'videos/kittens.mp4', '100', '2024-05-06T00:00:00.000Z'],
+    ]}, schema='Bucket, Key, Size, LastModifiedDate')
+    object_filter = ObjectFilter(prefix='photos/', max_size=1000, modified_since=datetime(2024, 1, 1))
+
+    assert list(Inventory(manifest).get_objects(object_filter)) == [('photos/kittens.jpg', 100, None)]
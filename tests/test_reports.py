@@ -0,0 +1,73 @@
+import csv
+import gzip
+import json
+
+from migro.reports import Report
+
+
+def test_report_formats(tmp_path):
+    rows = [('kittens.jpg', 3478134, 'file-uuid', 'uploaded', None),
+            ('invalid_format.csv', 339898, None, 'error', 'File validation error.')]
+
+    with Report(tmp_path / 'report.csv') as report:
+        report.write(iter(rows))
+    with open(tmp_path / 'report.csv', newline='') as file:
+        lines = list(csv.reader(file))
+    assert lines[0] == ['Path', 'File Size', 'Uploadcare UUID', 'Status', 'Error']
+    assert lines[2] == ['invalid_format.csv', '339898', '', 'error', 'File validation error.']
+
+    with Report(tmp_path / 'report.jsonl.gz', format='jsonl', compress=True) as report:
+        report.write(rows[:1])
+        report.flush()
+        report.write(rows[1:])
+    with gzip.open(tmp_path / 'report.jsonl.gz', 'rt') as file:
+        lines = [json.loads(line) for line in file]
+    assert lines == [
+        {'path': 'kittens.jpg', 'file_size': 3478134, 'uuid': 'file-uuid', 'status': 'uploaded', 'error': None},
+        {'path': 'invalid_format.csv', 'file_size': 339898, 'uuid': None, 'status': 'error',
+         'error': 'File validation error.'},
+    ]
+
+
+def test_incremental_report(db_manager, tmp_path):
+    db_manager.buffer_size = 2
+    files = [('kittens.jpg', 1, None), ('raccoons.jpg', 2, None), ('invalid_format.csv', 3, None)]
+    db_manager.insert_files(files, 's3')
+    report = Report(tmp_path / 'report.jsonl', format='jsonl')
+    db_manager.on_flush = report.write
+
+    def paths():
+        report.flush()
+        with open(report.filename) as file:
+            return [json.loads(line)['path'] for line in file]
+
+    db_manager.set_file_uploaded(1, 1, 'file-uuid')
+    assert paths() == []
+    db_manager.set_file_error(3, 'error')
+    assert paths() == ['kittens.jpg', 'invalid_format.csv']
+
+    db_manager.set_file_uploaded(2, 1, 'file-uuid')
+    db_manager.flush()
+    assert paths() == ['kittens.jpg', 'invalid_format.csv', 'raccoons.jpg']
+    report.close()
+
+
+def test_incremental_report_duplicates(db_manager, tmp_path):
+    files = [('kittens.jpg', 1, 'etag-1'), ('copy/kittens.jpg', 1, 'etag-1'), ('raccoons.jpg', 2, 'etag-2')]
+    db_manager.insert_files(files, 's3')
+    db_manager.mark_duplicates('s3')
+    attempt = db_manager.start_attempt('s3', 2)
+    db_manager.set_attempt_for_files(attempt)
+    report = Report(tmp_path / 'report.jsonl', format='jsonl')
+    db_manager.on_flush = report.write
+
+    db_manager.set_file_uploaded(1, attempt, 'kittens-uuid')
+    db_manager.set_file_uploaded(3, attempt, 'raccoons-uuid')
+    _, _, uploaded, failed = db_manager.finish_attempt(attempt)
+    report.close()
+
+    with open(report.filename) as file:
+        lines = [json.loads(line) for line in file]
+    assert len(lines) == uploaded == 3
+    assert {line['path']: line['uuid'] for line in lines} == {
+        'kittens.jpg': 'kittens-uuid', 'copy/kittens.jpg': 'kittens-uuid', 'raccoons.jpg': 'raccoons-uuid'}
@@ -0,0 +1,205 @@
+import datetime
+import threading
+from types import SimpleNamespace
+
+import boto3
+import botocore.auth
+import pytest
+from botocore.config import Config
+
+from migro import settings
+from migro.uploader.filters import ObjectFilter
+from migro.uploader.s3_client import S3Client
+from migro.uploader.s3_signer import S3Signer
+
+MODIFIED = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class FakePaginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, StartAfter=''):
+        keys = sorted(key for key in self.s3.objects if key.startswith(Prefix) and key > StartAfter)
+        objects, prefixes = [], []
+        for key in keys:
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefix = Prefix + rest[:rest.index(Delimiter) + 1]
+                if prefix not in prefixes:
+                    prefixes.append(prefix)
+            else:
+                objects.append(key)
+        for start in range(0, max(len(objects), 1), self.s3.page_size):
+            self.s3.requests.append((Prefix, Delimiter, threading.current_thread().name))
+            if self.s3.error and Prefix.startswith(self.s3.error):
+                raise RuntimeError('Listing failed')
+            page = {'Contents': [
+                {'Key': key, 'Size': self.s3.objects[key], 'ETag': f'"etag-{key}"',
+                 'LastModified': self.s3.modified.get(key, MODIFIED)}
+                for key in objects[start:start + self.s3.page_size]
+            ]}
+            if start == 0 and prefixes:
+                page['CommonPrefixes'] = [{'Prefix': prefix} for prefix in prefixes]
+            yield page
+
+
+class FakeS3:
+    """In-memory S3 bucket listing."""
+    def __init__(self, objects, page_size=2, error=None, modified=None):
+        self.objects = objects
+        self.modified = modified or {}
+        self.page_size = page_size
+        self.error = error
+        self.requests = []
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return FakePaginator(self)
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    for name in ('S3_ACCESS_KEY_ID', 'S3_SECRET_ACCESS_KEY', 'S3_REGION', 'S3_BUCKET_NAME'):
+        monkeypatch.setattr(settings, name, 'test')
+    return S3Client()
+
+
+OBJECTS = {
+    'root.jpg': 1,
+    'a/1.jpg': 2, 'a/2.jpg': 3, 'a/3.jpg': 4,
+    'b/x/1.jpg': 5, 'b/x/2.jpg': 6, 'b/y/1.jpg': 7, 'b/z.jpg': 8,
+    'c/1.jpg': 9,
+}
+
+
+def test_parallel_listing(s3_client, monkeypatch):
+    monkeypatch.setattr(settings, 'S3_LISTING_THREADS', 4)
+    s3_client.s3 = FakeS3(OBJECTS)
+
+    contents = list(s3_client.get_bucket_contents())
+
+    assert sorted(contents) == sorted((key, size, f'etag-{key}') for key, size in OBJECTS.items())
+    # Prefixes are discovered down to 2 levels and listed in the pool threads.
+    listed = {(prefix, delimiter) for prefix, delimiter, _ in s3_client.s3.requests}
+    assert listed == {('', '/'), ('a/', '/'), ('b/', '/'), ('c/', '/'), ('b/x/', None), ('b/y/', None)}
+    assert all(thread.startswith('migro-s3') for _, _, thread in s3_client.s3.requests)
+
+
+def test_partitioned_listing(s3_client, monkeypatch):
+    monkeypatch.setattr(settings, 'S3_LISTING_THREADS', 2)
+    monkeypatch.setattr(settings, 'S3_PARTITIONS', ['a', 'b', 'c', 'r'])
+    s3_client.s3 = FakeS3(OBJECTS)
+
+    assert sorted(key for key, _, _ in s3_client.get_bucket_contents()) == sorted(OBJECTS)
+    assert all(delimiter is None for _, delimiter, _ in s3_client.s3.requests)
+
+
+def test_sequential_listing(s3_client, monkeypatch):
+    monkeypatch.setattr(settings, 'S3_LISTING_THREADS', 1)
+    s3_client.s3 = FakeS3(OBJECTS)
+
+    assert [key for key, _, _ in s3_client.get_bucket_contents()] == sorted(OBJECTS)
+
+
+def test_listing_error(s3_client, monkeypatch):
+    monkeypatch.setattr(settings, 'S3_LISTING_THREADS', 4)
+    s3_client.s3 = FakeS3(OBJECTS, error='b/y/')
+
+    with pytest.raises(RuntimeError):
+        list(s3_client.get_bucket_contents())
+
+
+def test_resumed_listing(s3_client, monkeypatch):
+    monkeypatch.setattr(settings, 'S3_LISTING_THREADS', 4)
+    s3_client.s3 = FakeS3(OBJECTS)
+
+    # `b/x/` was found before `b/` stopped and is resumed on its own.
+    pages = list(s3_client.iter_listing([('a/', 1, 'a/1.jpg'), ('b/', 1, 'b/x/'), ('b/x/', 2, 'b/x/1.jpg'),
+                                         ('c/', 1, None)]))
+
+    keys = sorted(key for page in pages for key, _, _ in page.objects)
+    assert keys == ['a/2.jpg', 'a/3.jpg', 'b/x/2.jpg', 'b/y/1.jpg', 'b/z.jpg', 'c/1.jpg']
+    assert sorted(page.prefix for page in pages if page.last) == ['a/', 'b/', 'b/x/', 'b/y/', 'c/']
+    # Only the prefixes past the last listed one are found.
+    assert sorted(prefix for page in pages for prefix in page.prefixes) == [('b/y/', 2)]
+    assert [prefix for prefix, _, _ in s3_client.s3.requests].count('b/x/') == 1
+
+
+@pytest.mark.parametrize('region', ['us-east-1', 'eu-west-1'])
+@pytest.mark.parametrize('bucket', ['test-bucket', 'test.bucket'])
+@pytest.mark.parametrize('token', [None, 'session/token+'])
+def test_signer(monkeypatch, region, bucket, token):
+    now = datetime.datetime(2024, 5, 6, 7, 8, 9)
+    frozen = type('FrozenDatetime', (datetime.datetime,), {'utcnow': classmethod(lambda cls: now)})
+    monkeypatch.setattr(botocore.auth, 'datetime', SimpleNamespace(datetime=frozen))
+    session = boto3.Session(aws_access_key_id='AKID', aws_secret_access_key='secret',
+                            aws_session_token=token, region_name=region)
+    s3 = session.client('s3', config=Config(signature_version='s3v4', s3={'addressing_style': 'virtual'}))
+    signer = S3Signer(session.get_credentials(), region, bucket, s3.meta.endpoint_url, 900)
+    keys = ['kittens.jpg', 'a b/\u00fc+c~/(1).jpg', 'raccoons/*.png']
+
+    expected = [s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=900)
+                for key in keys]
+
+    assert signer.sign_many(keys, now.replace(tzinfo=datetime.timezone.utc).timestamp()) == expected
+    assert signer.sign(keys[1], now.replace(tzinfo=datetime.timezone.utc).timestamp()) == expected[1]
+
+
+def test_signed_urls(s3_client):
+    url = s3_client.create_signed_url('kittens.jpg')
+
+    assert url.startswith('https://test.s3.test.amazonaws.com/kittens.jpg?X-Amz-Algorithm=AWS4-HMAC-SHA256&')
+    assert 'X-Amz-Expires=3600&' in url
+    assert list(s3_client.create_signed_urls(['a.jpg', 'b.jpg'])) == ['a.jpg', 'b.jpg']
+
+
+def test_object_filter():
+    object_filter = ObjectFilter(prefix='photos/', include=['*.jpg', '*.png'], exclude=['photos/tmp/*'],
+                                 min_size=10, max_size=100, modified_since=datetime.datetime(2024, 1, 1))
+
+    assert object_filter('photos/kittens.jpg', 50, MODIFIED)
+    assert object_filter('photos/kittens.png')
+    assert not object_filter('videos/kittens.jpg', 50, MODIFIED)
+    assert not object_filter('photos/kittens.gif', 50, MODIFIED)
+    assert not object_filter('photos/tmp/kittens.jpg', 50, MODIFIED)
+    assert not object_filter('photos/kittens.jpg', 5, MODIFIED)
+    assert not object_filter('photos/kittens.jpg', 500, MODIFIED)
+    assert not object_filter('photos/kittens.jpg', 50, datetime.datetime(2023, 12, 31))
+    assert object_filter.skips_prefix('photos/tmp/')
+    assert not object_filter.skips_prefix('photos/')
+    assert object_filter.conditions == ('include=*.jpg include=*.png exclude=photos/tmp/* min_size=10 '
+                                        'max_size=100 modified_since=2024-01-01T00:00:00+00:00')
+    assert ObjectFilter(prefix='photos/', shard=(0, 2)).conditions == 'shard=1/2'
+    assert ObjectFilter(prefix='photos/').conditions == ''
+    assert ObjectFilter(prefix='photos/') and not ObjectFilter()
+    assert ObjectFilter(min_size=10).key_filter is None
+    assert ObjectFilter(shard=(0, 2)).key_filter('kittens.jpg') != ObjectFilter(shard=(1, 2)).key_filter('kittens.jpg')
+
+
+def test_filtered_listing(s3_client, monkeypatch):
+    monkeypatch.setattr(settings, 'S3_LISTING_THREADS', 4)
+    s3_client.s3 = FakeS3(OBJECTS, modified={'b/z.jpg': datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)})
+    s3_client.filter = ObjectFilter(prefix='b/', exclude=['b/y/*'], max_size=7,
+                                    modified_since=datetime.datetime(2023, 6, 1))
+
+    assert sorted(key for key, _, _ in s3_client.get_bucket_contents()) == ['b/x/1.jpg', 'b/x/2.jpg']
+    # Only the keys under the prefix are listed, excluded prefixes are skipped.
+    assert {prefix for prefix, _, _ in s3_client.s3.requests} == {'b/', 'b/x/'}
+    assert s3_client.listing_name == ('test/b/ [exclude=b/y/* max_size=7 '
+                                      'modified_since=2023-06-01T00:00:00+00:00]')
+
+
+def test_sharded_listing(s3_client, monkeypatch):
+    keys = []
+    names = set()
+    for index in range(3):
+        s3_client.s3 = FakeS3(OBJECTS)
+        s3_client.filter = ObjectFilter(shard=(index, 3))
+        keys.append({key for key, _, _ in s3_client.get_bucket_contents()})
+        names.add(s3_client.listing_name)
+
+    assert set.union(*keys) == set(OBJECTS)
+    assert sum(len(shard) for shard in keys) == len(OBJECTS)
+    # Every shard saves its own listing position.
+    assert names == {'test [shard=1/3]', 'test [shard=2/3]', 'test [shard=3/3]'}
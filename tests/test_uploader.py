@@ -1,16 +1,28 @@
 import asyncio
+import multiprocessing
+import time
 from unittest.mock import AsyncMock
 
+import pytest
+from aiohttp import ClientConnectionError, web
+
 from migro import __version__, settings
-from migro.uploader.utils import loop, request, session
-from migro.uploader.worker import Events, Uploader
+from migro.uploader.client import UploadAPIClient
+from migro.uploader.concurrency import ConcurrencyLimiter
+from migro.uploader.events import EventBus
+from migro.uploader.poller import StatusPoller
+from migro.uploader.rate_limit import RateLimiter
+from migro.uploader.transport import Transport
+from migro.uploader.utils import generate_secure_signature, loop
+from migro.uploader.worker import Events, File, Uploader
+from tests.conftest import MockResponse
 
 
-def test_uploader(mock_session):
+def test_uploader(mock_client):
     successful = []
     failed = []
 
-    uploader = Uploader(loop=loop)
+    uploader = Uploader(loop=loop, client=mock_client)
 
     uploader.on(
         Events.UPLOAD_ERROR,
@@ -32,17 +44,441 @@ def test_uploader(mock_session):
     assert not failed
 
 
+def test_uploader_file_ids(mock_client):
+    uploaded = {}
+    uploader = Uploader(loop=loop, client=mock_client)
+    uploader.on(
+        Events.DOWNLOAD_COMPLETE,
+        callback=lambda event: uploaded.update({event.file.id: event.file.uuid}),
+    )
+
+    files = [File(f'http://file-url/{number}', id=number) for number in range(1, 4)]
+    loop.run_until_complete(uploader.process(files))
+    uploader.shutdown()
+
+    assert uploaded == {1: 'file-uuid', 2: 'file-uuid', 3: 'file-uuid'}
+
+
 def test_headers():
     settings.PUBLIC_KEY = "public"
 
-    mock = AsyncMock(return_value="ok")
+    response = MockResponse("ok", 200)
+    mock = AsyncMock(return_value=response)
 
-    original_request = session.request
-    session.request = mock
-    resp = asyncio.run(request('path'))
-    session.request = original_request
+    client = UploadAPIClient.from_settings()
+    client.transport.request = mock
+    resp = asyncio.run(client.request('path'))
 
     expected_ua = f"Migro/{__version__}/public"
     assert expected_ua == mock.call_args.kwargs["headers"]["User-Agent"]
 
-    assert "ok" == resp
+    assert response is resp
+
+
+def test_cached_signature():
+    now = [1000000.0]
+    mock = AsyncMock(return_value=MockResponse("ok", 200))
+    client = UploadAPIClient('public', 'secret', transport=AsyncMock(request=mock),
+                             clock=lambda: now[0])
+
+    loop.run_until_complete(client.request('from_url/', {'source_url': 'http://file-url'}))
+    params = mock.call_args.kwargs['params']
+    assert mock.call_args.kwargs['url'] == 'https://upload.uploadcare.com/from_url/'
+    assert params['pub_key'] == params['UPLOADCARE_PUB_KEY'] == 'public'
+    assert params['source_url'] == 'http://file-url'
+    assert params['expire'] == 1000000 + 5 * 60
+    assert params['signature'] == generate_secure_signature('secret', params['expire'])
+
+    # The signature is reused while it is far from expiration.
+    now[0] += 60
+    loop.run_until_complete(client.request('from_url/status/', {'token': 'token'}))
+    assert mock.call_args.kwargs['params']['signature'] == params['signature']
+    assert 'source_url' not in mock.call_args.kwargs['params']
+
+    now[0] += 4 * 60
+    loop.run_until_complete(client.request('from_url/status/', {'token': 'token'}))
+    assert mock.call_args.kwargs['params']['expire'] == 1000000 + 10 * 60
+
+
+class SequenceTransport:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    async def request(self, *args, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+def test_status_poller(monkeypatch):
+    fake_transport = SequenceTransport([
+        MockResponse({'status': 'waiting'}, 200),
+        MockResponse({'status': 'progress', 'done': 10, 'total': 100}, 200),
+        MockResponse({'status': 'success', 'uuid': 'file-uuid'}, 200),
+    ])
+    client = UploadAPIClient('public', transport=fake_transport)
+
+    poller = StatusPoller(client, loop=loop, min_interval=0.01, max_interval=0.05, rate=1000, timeout=5)
+    file = File('http://file-url')
+    file.upload_token = 'token'
+
+    runner = asyncio.ensure_future(poller.run(), loop=loop)
+    outcome = loop.run_until_complete(poller.wait(file))
+    runner.cancel()
+    loop.run_until_complete(asyncio.gather(runner, return_exceptions=True))
+
+    assert outcome == StatusPoller.SUCCESS
+    assert file.uuid == 'file-uuid'
+    assert fake_transport.calls == 3
+
+
+def test_status_poller_timeout(monkeypatch):
+    fake_transport = SequenceTransport([MockResponse({'status': 'waiting'}, 200)])
+    client = UploadAPIClient('public', transport=fake_transport)
+
+    poller = StatusPoller(client, loop=loop, min_interval=0.01, max_interval=0.02, rate=1000, timeout=0.1)
+    file = File('http://file-url')
+    file.upload_token = 'token'
+
+    runner = asyncio.ensure_future(poller.run(), loop=loop)
+    outcome = loop.run_until_complete(poller.wait(file))
+    runner.cancel()
+    loop.run_until_complete(asyncio.gather(runner, return_exceptions=True))
+
+    assert outcome == StatusPoller.TIMEOUT
+    assert file.error == 'Status check timeout.'
+    # Backed off checks make less requests than fixed interval polling.
+    assert fake_transport.calls < 10
+
+
+def test_status_poller_rate_grows_with_tokens():
+    fake_transport = SequenceTransport([MockResponse({'status': 'success', 'uuid': 'file-uuid'}, 200)])
+    client = UploadAPIClient('public', transport=fake_transport)
+
+    # 200 tokens checked at once per 0.1 seconds are 2000 requests per second, not 1.
+    poller = StatusPoller(client, loop=loop, min_interval=0.01, max_interval=0.1, rate=1, timeout=5)
+    files = [File(f'http://file-url/{number}') for number in range(200)]
+    for file in files:
+        file.upload_token = 'token'
+
+    runner = asyncio.ensure_future(poller.run(), loop=loop)
+    started = loop.time()
+    outcomes = loop.run_until_complete(asyncio.wait_for(
+        asyncio.gather(*(poller.track(file) for file in files)), 5))
+    poller.stop()
+    loop.run_until_complete(runner)
+
+    assert outcomes == [StatusPoller.SUCCESS] * 200
+    assert loop.time() - started < 2
+
+
+def test_status_poller_throttled_timeout():
+    throttled = MockResponse('Throttled', 429)
+    throttled.headers = {'Retry-After': '0.01'}
+    fake_transport = SequenceTransport([throttled])
+    client = UploadAPIClient('public', transport=fake_transport)
+
+    poller = StatusPoller(client, loop=loop, min_interval=0.01, max_interval=0.02, rate=1000, timeout=0.1)
+    file = File('http://file-url')
+    file.upload_token = 'token'
+
+    runner = asyncio.ensure_future(poller.run(), loop=loop)
+    outcome = loop.run_until_complete(asyncio.wait_for(poller.wait(file), 1))
+    poller.stop()
+    loop.run_until_complete(runner)
+
+    assert outcome == StatusPoller.TIMEOUT
+    assert file.error == 'Status check timeout.'
+
+
+def test_status_poller_cancel_on_wakeup():
+    poller = StatusPoller(UploadAPIClient('public', transport=SequenceTransport([])), loop=loop)
+    file = File('http://file-url')
+    file.upload_token = 'token'
+    poller.track(file)
+
+    runner = asyncio.ensure_future(poller.run(), loop=loop)
+    loop.run_until_complete(asyncio.sleep(0.01))
+    # The wakeup and the cancellation arrive at once.
+    poller._wakeup.set()
+    runner.cancel()
+    loop.run_until_complete(asyncio.wait([runner], timeout=1))
+
+    assert runner.cancelled()
+
+
+def test_status_poller_stop():
+    poller = StatusPoller(UploadAPIClient('public', transport=SequenceTransport([])), loop=loop)
+
+    runner = asyncio.ensure_future(poller.run(), loop=loop)
+    loop.run_until_complete(asyncio.sleep(0.01))
+    poller.stop()
+    loop.run_until_complete(asyncio.wait([runner], timeout=1))
+
+    assert runner.done() and not runner.cancelled()
+
+
+class RoutingTransport:
+    """Answers `from_url/` with a token and makes status checks wait."""
+    def __init__(self, waiting_checks):
+        self.waiting_checks = waiting_checks
+        self.status_checks = 0
+
+    async def request(self, method, url, **kwargs):
+        if url.endswith('from_url/'):
+            return MockResponse({'token': kwargs['params']['source_url']}, 200)
+        self.status_checks += 1
+        if self.status_checks <= self.waiting_checks:
+            return MockResponse({'status': 'waiting'}, 200)
+        return MockResponse({'status': 'success', 'uuid': 'file-uuid'}, 200)
+
+
+def test_uploader_stages(monkeypatch):
+    client = UploadAPIClient('public', transport=RoutingTransport(waiting_checks=5))
+    monkeypatch.setattr(settings, 'MAX_CONCURRENT_UPLOADS', 1)
+    monkeypatch.setattr(settings, 'STATUS_CHECK_INTERVAL', 0.01)
+    monkeypatch.setattr(settings, 'STATUS_CHECK_MAX_INTERVAL', 0.01)
+
+    events = []
+    uploader = Uploader(loop=loop, client=client)
+    uploader.on(*Uploader.EVENTS, callback=lambda event: events.append(event['type']))
+
+    urls = ['http://file-url/{0}'.format(i) for i in range(5)]
+    loop.run_until_complete(uploader.process(urls))
+    uploader.shutdown()
+
+    # Single submission slot is not held while files are downloaded.
+    assert events[:5] == [Events.UPLOAD_COMPLETE] * 5
+    assert events.count(Events.DOWNLOAD_COMPLETE) == 5
+
+
+def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter(8, minimum=2, adaptive=True, loop=loop)
+
+    limiter.throttled()
+    assert limiter.limit == 4
+    # Throttled requests sent before the cut don't cut it again.
+    limiter.throttled()
+    assert limiter.limit == 4
+
+    for _ in range(4):
+        limiter.succeeded(0.1)
+    assert limiter.limit == 5
+    # Never goes beyond the static limit.
+    for _ in range(100):
+        limiter.succeeded(0.1)
+    assert limiter.limit == 8
+
+    # Growing latency stops the increase.
+    limiter.limit = 6
+    for _ in range(12):
+        limiter.succeeded(1.0)
+    assert limiter.limit == 6
+
+    limiter._last_decrease = None
+    for _ in range(15):
+        limiter.failed()
+    assert limiter.limit == 3
+
+
+def test_static_concurrency_limiter():
+    limiter = ConcurrencyLimiter(8, loop=loop)
+    limiter.throttled()
+    limiter.failed()
+    assert limiter.limit == 8
+
+
+def test_rate_limiter_pause():
+    now = [0.0]
+    limiter = RateLimiter(rate=2, clock=lambda: now[0])
+
+    async def sleep(delay):
+        now[0] += delay
+
+    async def acquire_all(count):
+        for _ in range(count):
+            await limiter.acquire()
+
+    original_sleep = asyncio.sleep
+    asyncio.sleep = sleep
+    try:
+        # Burst up to the capacity, then two requests per second.
+        loop.run_until_complete(acquire_all(4))
+        assert now[0] == 1.0
+
+        limiter.pause(10)
+        assert limiter.paused
+        loop.run_until_complete(acquire_all(2))
+    finally:
+        asyncio.sleep = original_sleep
+
+    # Resumed smoothly after the pause, not in a burst.
+    assert now[0] == 12.0
+    assert not limiter.paused
+
+
+def test_rate_limiter_shared_pause():
+    shared = multiprocessing.get_context('spawn').Value('d', 0.0)
+    limiter, other = RateLimiter(shared=shared), RateLimiter(shared=shared)
+
+    limiter.pause(0.2)
+    started = time.monotonic()
+    loop.run_until_complete(other.acquire())
+
+    # A pause made by one process pauses the others too.
+    assert time.monotonic() - started >= 0.15
+    assert shared.value > 0
+
+
+def test_uploader_streaming_input(monkeypatch):
+    client = UploadAPIClient('public', transport=RoutingTransport(waiting_checks=0))
+    monkeypatch.setattr(settings, 'MAX_CONCURRENT_UPLOADS', 1)
+    monkeypatch.setattr(settings, 'MAX_CONCURRENT_STATUS_CHECKS', 2)
+    monkeypatch.setattr(settings, 'STAGE_QUEUE_SIZE', 2)
+    monkeypatch.setattr(settings, 'STATUS_CHECK_INTERVAL', 0.001)
+
+    produced = []
+    completed = []
+    read_ahead = []
+
+    async def urls():
+        for i in range(20):
+            read_ahead.append(len(produced) - len(completed))
+            produced.append(i)
+            yield 'http://file-url/{0}'.format(i)
+
+    uploader = Uploader(loop=loop, client=client)
+    uploader.on(Events.DOWNLOAD_COMPLETE, callback=completed.append)
+    loop.run_until_complete(uploader.process(urls()))
+    uploader.shutdown()
+
+    assert len(completed) == 20
+    # Input is held back by the bounded queues instead of being read at once.
+    # Queues, submission and status check slots.
+    assert max(read_ahead) <= 2 + 1 + 2 + 2 + 2 + 1
+
+
+class FlakyTransport(RoutingTransport):
+    """Fails `from_url/` requests with `failures` before answering."""
+    def __init__(self, failures):
+        super().__init__(waiting_checks=0)
+        self.failures = list(failures)
+
+    async def request(self, method, url, **kwargs):
+        if url.endswith('from_url/') and self.failures:
+            failure = self.failures.pop(0)
+            if isinstance(failure, Exception):
+                raise failure
+            return MockResponse('Internal error', failure)
+        return await super().request(method, url, **kwargs)
+
+
+def test_uploader_retries(monkeypatch):
+    client = UploadAPIClient('public', transport=FlakyTransport([ClientConnectionError(), 502]))
+    monkeypatch.setattr(settings, 'STATUS_CHECK_INTERVAL', 0.001)
+    monkeypatch.setattr(settings, 'RETRY_BACKOFF', 0.001)
+
+    events = []
+    uploader = Uploader(loop=loop, client=client)
+    uploader.on(*Uploader.EVENTS, callback=lambda event: events.append(event['type']))
+    files = []
+    uploader.on(Events.DOWNLOAD_COMPLETE, callback=lambda event: files.append(event['file']))
+
+    loop.run_until_complete(uploader.process(['http://file-url']))
+    uploader.shutdown()
+
+    assert events.count(Events.UPLOAD_RETRY) == 2
+    assert events[-1] == Events.DOWNLOAD_COMPLETE
+    assert files[0].retries == 2
+    assert files[0].error is None
+
+
+def test_uploader_signs_every_submission(monkeypatch):
+    transport = FlakyTransport([502])
+    client = UploadAPIClient('public', transport=transport)
+    monkeypatch.setattr(settings, 'STATUS_CHECK_INTERVAL', 0.001)
+    monkeypatch.setattr(settings, 'RETRY_BACKOFF', 0.001)
+
+    signed = []
+    def sign(key):
+        signed.append(key)
+        return f'http://signed-url/{key}?signature={len(signed)}'
+
+    uploader = Uploader(loop=loop, client=client, sign=sign)
+    loop.run_until_complete(uploader.process(['kittens.jpg']))
+    uploader.shutdown()
+
+    # The retry is submitted with a freshly signed url.
+    assert signed == ['kittens.jpg', 'kittens.jpg']
+
+
+def test_uploader_out_of_retries(monkeypatch):
+    client = UploadAPIClient('public', transport=FlakyTransport([500] * 10))
+    monkeypatch.setattr(settings, 'RETRY_BACKOFF', 0.001)
+    monkeypatch.setattr(settings, 'MAX_RETRIES', 2)
+
+    failed = []
+    uploader = Uploader(loop=loop, client=client)
+    uploader.on(Events.UPLOAD_ERROR, callback=lambda event: failed.append(event['file']))
+
+    loop.run_until_complete(uploader.process(['http://file-url']))
+    uploader.shutdown()
+
+    assert failed[0].retries == 2
+    assert failed[0].error == 'UPLOAD_ERROR: Internal error'
+
+
+def test_transport_releases_connections():
+    async def throttled(request):
+        return web.json_response({'detail': 'Throttled'}, status=429)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/', throttled)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        single_connection = Transport(limit=1)
+        try:
+            responses = [
+                await asyncio.wait_for(single_connection.request('get', f'http://127.0.0.1:{port}/'), 5)
+                for _ in range(5)
+            ]
+        finally:
+            await single_connection.close()
+            await runner.cleanup()
+        return responses
+
+    responses = loop.run_until_complete(run())
+
+    # The only connection is released after every response.
+    assert [response.status for response in responses] == [429] * 5
+    assert loop.run_until_complete(responses[0].json()) == {'detail': 'Throttled'}
+
+
+def test_event_bus_batches():
+    bus = EventBus(Uploader.EVENTS, loop=loop)
+    single = []
+    batches = []
+    bus.on(Events.DOWNLOAD_COMPLETE, callback=single.append)
+    bus.on_batch(Events.DOWNLOAD_COMPLETE, Events.DOWNLOAD_ERROR, callback=batches.append, size=2)
+
+    files = [File('http://file-url/{0}'.format(i), id=i) for i in range(3)]
+    bus.emit(Events.DOWNLOAD_COMPLETE, files[0])
+    # Plain callbacks are called right away.
+    assert single[0]['file'] is files[0]
+    assert single[0].type == Events.DOWNLOAD_COMPLETE
+    assert not batches
+
+    bus.emit(Events.DOWNLOAD_ERROR, files[1])
+    bus.emit(Events.DOWNLOAD_COMPLETE, files[2])
+    assert [[event.file.id for event in batch] for batch in batches] == [[0, 1]]
+
+    bus.flush()
+    assert [[event.file.id for event in batch] for batch in batches] == [[0, 1], [2]]
+
+    with pytest.raises(TypeError):
+        bus.on(Events.UPLOAD_COMPLETE, 'unknown', callback=print)